@@ -17,6 +17,8 @@ from gunicorn.six import iteritems
 
 from taskflow import Scheduler, Pusher, Taskflow, Worker, TaskInstance
 from taskflow import db
+from taskflow.core.scheduler import LeaderLock
+from taskflow.core.worker import TaskInstanceListener, WorkerPool, PreforkWorkerPool
 from taskflow.rest.app import create_app
 
 def get_logging():
@@ -143,10 +145,33 @@ def migrate_db(ctx, sql_alchemy_connection):
 @click.option('--dry-run', is_flag=True, default=False)
 @click.option('--now-override')
 @click.option('--sleep', type=int, default=5)
+@click.option('--leader-lock/--no-leader-lock', default=True,
+              help='Only run while holding the leader lock, so several schedulers can run as standbys')
+@click.option('--advance-threads', type=int, default=1,
+              help='Number of threads advancing workflow instances in parallel')
+@click.option('--lookahead', type=int, default=0,
+              help='Seconds ahead of their run_at to start workflow instances')
+@click.option('--push-batch-size', type=int, default=100,
+              help='Task instances pulled and pushed per batch by the pusher')
+@click.option('--reconcile-interval', type=int, default=300,
+              help='Seconds between polling push destinations that have a state event source')
+@click.option('--batch-event-queue-url',
+              help='SQS queue of AWS Batch job state change events, for the aws_batch push worker')
 @click.pass_context
-def scheduler(ctx, sql_alchemy_connection, num_runs, dry_run, now_override, sleep):
+def scheduler(ctx,
+              sql_alchemy_connection,
+              num_runs,
+              dry_run,
+              now_override,
+              sleep,
+              leader_lock,
+              advance_threads,
+              lookahead,
+              push_batch_size,
+              reconcile_interval,
+              batch_event_queue_url):
     connection_string = sql_alchemy_connection or os.getenv('SQL_ALCHEMY_CONNECTION')
-    engine = create_engine(connection_string)
+    engine = create_engine(connection_string, pool_size=max(5, advance_threads + 2))
     Session = sessionmaker(bind=engine)
 
     session = Session()
@@ -157,24 +182,57 @@ def scheduler(ctx, sql_alchemy_connection, num_runs, dry_run, now_override, slee
     if now_override != None:
         now_override = datetime.strptime(now_override, '%Y-%m-%dT%H:%M:%S')
 
-    scheduler = Scheduler(taskflow, dry_run=dry_run, now_override=now_override)
-    pusher = Pusher(taskflow, dry_run=dry_run, now_override=now_override)
+    scheduler = Scheduler(taskflow,
+                          dry_run=dry_run,
+                          now_override=now_override,
+                          advance_threads=advance_threads,
+                          session_factory=Session,
+                          lookahead=lookahead)
+    if batch_event_queue_url != None:
+        from taskflow.push_workers.aws_batch import SQSJobEventSource
+
+        push_worker = taskflow.get_push_worker('aws_batch')
+        if push_worker == None:
+            raise click.UsageError('--batch-event-queue-url requires an aws_batch push worker')
+        push_worker.event_source = SQSJobEventSource(batch_event_queue_url)
+
+    pusher = Pusher(taskflow,
+                    dry_run=dry_run,
+                    now_override=now_override,
+                    max_tasks=push_batch_size,
+                    reconcile_interval=reconcile_interval)
+
+    if leader_lock:
+        leader_lock = LeaderLock(engine)
+    else:
+        leader_lock = None
 
     ## TODO: fix interrupt
 
-    for n in range(0, num_runs):
-        if n > 0 and sleep > 0:
-            time.sleep(sleep)
-
-        session = Session()
-        taskflow.sync_db(session)
-        scheduler.run(session)
-        session.close()
-
-        session = Session()
-        taskflow.sync_db(session)
-        pusher.run(session)
-        session.close()
+    try:
+        for n in range(0, num_runs):
+            if n > 0 and sleep > 0:
+                time.sleep(sleep)
+
+            ## standbys try to take over every cycle
+            if leader_lock != None and not leader_lock.acquire():
+                logging.getLogger('Scheduler').info('Not the leader, standing by')
+                continue
+
+            session = Session()
+            taskflow.sync_db(session)
+            scheduler.run(session)
+            session.close()
+
+            session = Session()
+            taskflow.sync_db(session)
+            pusher.run(session)
+            session.close()
+    finally:
+        pusher.close()
+
+        if leader_lock != None:
+            leader_lock.release()
 
 @main.command()
 @click.option('--sql-alchemy-connection')
@@ -184,10 +242,28 @@ def scheduler(ctx, sql_alchemy_connection, num_runs, dry_run, now_override, slee
 @click.option('--sleep', type=int, default=5)
 @click.option('--task-names')
 @click.option('--worker-id')
+@click.option('--listen/--no-listen', default=True)
+@click.option('--slots', type=int, default=1)
+@click.option('--prefork', is_flag=True, default=False)
+@click.option('--max-tasks-per-child', type=int)
+@click.option('--max-child-rss', type=int, help='Megabytes')
 @click.pass_context
-def pull_worker(ctx, sql_alchemy_connection, num_runs, dry_run, now_override, sleep, task_names, worker_id):
+def pull_worker(ctx,
+                sql_alchemy_connection,
+                num_runs,
+                dry_run,
+                now_override,
+                sleep,
+                task_names,
+                worker_id,
+                listen,
+                slots,
+                prefork,
+                max_tasks_per_child,
+                max_child_rss):
     connection_string = sql_alchemy_connection or os.getenv('SQL_ALCHEMY_CONNECTION')
-    engine = create_engine(connection_string)
+    ## one connection per slot, plus the pulling session and the listener
+    engine = create_engine(connection_string, pool_size=max(5, slots + 2))
     Session = sessionmaker(bind=engine)
 
     session = Session()
@@ -206,18 +282,82 @@ def pull_worker(ctx, sql_alchemy_connection, num_runs, dry_run, now_override, sl
     if worker_id == None:
         worker_id = get_worker_id()
 
+    ## wakes up on NOTIFY when a task is queued, sleep is the fallback timeout
+    listener = None
+    if listen:
+        listener = TaskInstanceListener(engine, task_names=task_names)
+
+    ## with multiple slots, claim up to the number of free slots per pull and
+    ## execute them concurrently, each task instance in its own session.
+    ## prefork runs each slot in a child process instead of a thread
+    pool = None
+    if prefork:
+        max_rss = None
+        if max_child_rss != None:
+            max_rss = max_child_rss * 1024 * 1024
+        pool = PreforkWorkerPool(taskflow,
+                                 engine,
+                                 slots,
+                                 max_tasks_per_child=max_tasks_per_child,
+                                 max_rss=max_rss)
+    elif slots > 1:
+        pool = WorkerPool(worker, Session, slots)
+
+    executed = False
+    next_eligible_at = None
     for n in range(0, num_runs):
-        if n > 0 and sleep > 0:
-            time.sleep(sleep)
+        if pool and pool.free_slots() == 0:
+            pool.wait()
+        ## keep pulling without waiting while there is work
+        elif n > 0 and sleep > 0 and not executed:
+            ## wake up when the next known task instance is due, if before the sleep interval
+            timeout = sleep
+            if next_eligible_at != None:
+                due_in = (next_eligible_at - (now_override or datetime.utcnow())).total_seconds()
+                timeout = max(0, min(sleep, due_in))
+
+            if listener:
+                listener.wait(timeout)
+            else:
+                time.sleep(timeout)
 
         session = Session()
-        
-        task_instances = taskflow.pull(session, worker_id, task_names=task_names, now=now_override)
-        
-        if len(task_instances) > 0:
-            worker.execute(session, task_instances[0])
 
-        session.close()
+        if pool:
+            task_instances = taskflow.pull(
+                session,
+                worker_id,
+                task_names=task_names,
+                max_tasks=pool.free_slots(),
+                now=now_override)
+            task_instance_ids = [task_instance.id for task_instance in task_instances]
+            session.commit()
+
+            executed = len(task_instance_ids) > 0
+            if not executed:
+                next_eligible_at = taskflow.get_next_eligible_at(session, task_names=task_names, now=now_override)
+            session.close()
+
+            for task_instance_id in task_instance_ids:
+                pool.submit(task_instance_id)
+        else:
+            task_instances = taskflow.pull(session, worker_id, task_names=task_names, now=now_override)
+            ## commit the claim, holding it open would hold the concurrency count locks
+            session.commit()
+
+            executed = len(task_instances) > 0
+            if executed:
+                worker.execute(session, task_instances[0])
+            else:
+                next_eligible_at = taskflow.get_next_eligible_at(session, task_names=task_names, now=now_override)
+
+            session.close()
+
+    if pool:
+        pool.shutdown()
+
+    if listener:
+        listener.close()
 
 @main.command()
 @click.argument('task_instance_id', type=int)
@@ -316,6 +456,40 @@ def queue_workflow(ctx, workflow_name, run_at, priority, sql_alchemy_connection)
     session.commit()
     session.close()
 
+@main.command()
+@click.argument('name')
+@click.argument('start_date')
+@click.argument('end_date')
+@click.option('--priority')
+@click.option('--dry-run', is_flag=True, default=False)
+@click.option('--sql-alchemy-connection')
+@click.pass_context
+def backfill(ctx, name, start_date, end_date, priority, dry_run, sql_alchemy_connection):
+    """Queues every scheduled run of a recurring Workflow or Task from START_DATE through
+       END_DATE, formatted as 2017-06-03T06:00:00"""
+    connection_string = sql_alchemy_connection or os.getenv('SQL_ALCHEMY_CONNECTION')
+    engine = create_engine(connection_string)
+    Session = sessionmaker(bind=engine)
+
+    session = Session()
+
+    taskflow = ctx.obj['taskflow']
+    taskflow.sync_db(session)
+
+    item = taskflow.get_workflow(name) or taskflow.get_task(name)
+
+    if item == None:
+        raise Exception('Workflow or Task `{}` not found'.format(name))
+
+    start_date = datetime.strptime(start_date, '%Y-%m-%dT%H:%M:%S')
+    end_date = datetime.strptime(end_date, '%Y-%m-%dT%H:%M:%S')
+
+    scheduler = Scheduler(taskflow, dry_run=dry_run)
+    queued = scheduler.backfill(session, item, start_date, end_date, priority=priority)
+    click.echo('Queued {} runs of {}'.format(queued, name))
+
+    session.close()
+
 def cli(taskflow):
     return main(obj={'taskflow': taskflow})
 
@@ -1,8 +1,13 @@
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta
+from types import MappingProxyType
+import logging
+import zlib
 
 from sqlalchemy import (
     Column,
     Integer,
+    SmallInteger,
     BigInteger,
     String,
     DateTime,
@@ -12,13 +17,16 @@ from sqlalchemy import (
     func,
     text,
     ForeignKey,
-    MetaData
+    MetaData,
+    DDL,
+    inspect
 )
 from sqlalchemy.orm import relationship
-from sqlalchemy.event import listens_for
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.event import listens_for, listen
+from sqlalchemy.dialects.postgresql import JSONB, insert
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from croniter import croniter
+from toposort import toposort_flatten
 from restful_ben.auth import UserAuthMixin
 from flask_login import UserMixin
 
@@ -31,6 +39,8 @@ class Schedulable(object):
     name = Column(String, primary_key=True)
     active = Column(Boolean, nullable=False)
 
+    fingerprint_columns = ['name']
+
     def __init__(
         self,
         name=None,
@@ -42,7 +52,8 @@ class Schedulable(object):
         schedule=None,
         default_priority='normal',
         start_date=None,
-        end_date=None):
+        end_date=None,
+        jitter=None):
 
         self.name = name
         if not self.name:
@@ -58,28 +69,83 @@ class Schedulable(object):
         self.default_priority = default_priority
         self.start_date = start_date
         self.end_date = end_date
+        self.jitter = jitter
+
+    def get_fingerprint(self, include_active=False):
+        """Values of the definition's database columns, used to detect changed definitions.
+           `active` is owned by the database once the row exists."""
+        fingerprint = dict((column, getattr(self, column)) for column in self.fingerprint_columns)
+        if include_active:
+            fingerprint['active'] = self.active
+        return fingerprint
+
+    def get_jitter_offset(self):
+        """Seconds the schedule's fire times are offset by, a stable hash of the name within
+           the jitter window, so runs are spread out but predictable per definition"""
+        if not self.jitter:
+            return timedelta(0)
+        return timedelta(seconds=(zlib.crc32(self.name.encode('utf-8')) & 0xffffffff) % self.jitter)
 
     def next_run(self, base_time=None):
         if not base_time:
             base_time = datetime.utcnow()
-        iter = croniter(self.schedule, base_time)
-        return iter.get_next(datetime)
+        offset = self.get_jitter_offset()
+        iter = croniter(self.schedule, base_time - offset)
+        return iter.get_next(datetime) + offset
 
     def last_run(self, base_time=None):
         if not base_time:
             base_time = datetime.utcnow()
-        iter = croniter(self.schedule, base_time)
-        return iter.get_prev(datetime)
+        offset = self.get_jitter_offset()
+        iter = croniter(self.schedule, base_time - offset)
+        return iter.get_prev(datetime) + offset
+
+## compiled, read only, dependency graph of a Workflow
+##   order - task names in topological order
+##   dependencies - task name -> frozenset of the task names it depends on
+##   dependents - task name -> frozenset of the task names that depend on it
+##   indegrees - task name -> number of dependencies
+##   roots - frozenset of the task names without dependencies
+WorkflowGraph = namedtuple('WorkflowGraph', ['order', 'dependencies', 'dependents', 'indegrees', 'roots'])
+
+def compile_graph(workflow_name, graph):
+    for task_name, dependencies in graph.items():
+        for dependency in dependencies:
+            if dependency not in graph:
+                raise Exception('`{}` depends on `{}`, which is not in workflow `{}`'.format(
+                    task_name,
+                    dependency,
+                    workflow_name))
+
+    ## raises toposort.CircularDependencyError on cycles
+    order = tuple(toposort_flatten(graph))
+
+    dependents = dict((task_name, set()) for task_name in graph)
+    for task_name, dependencies in graph.items():
+        for dependency in dependencies:
+            dependents[dependency].add(task_name)
+
+    return WorkflowGraph(
+        order=order,
+        dependencies=MappingProxyType(dict(
+            (task_name, frozenset(dependencies)) for task_name, dependencies in graph.items())),
+        dependents=MappingProxyType(dict(
+            (task_name, frozenset(names)) for task_name, names in dependents.items())),
+        indegrees=MappingProxyType(dict(
+            (task_name, len(dependencies)) for task_name, dependencies in graph.items())),
+        roots=frozenset(task_name for task_name, dependencies in graph.items() if len(dependencies) == 0))
 
 class Workflow(Schedulable, BaseModel):
     __tablename__ = 'workflows'
 
     _tasks = None
+    _graph = None
+    _taskflow = None
 
     def __init__(self, *args, **kwargs):
         super(Workflow, self).__init__(*args, **kwargs)
 
-        self._tasks = set()
+        self._tasks = dict() ## task name -> Task
 
     def __repr__(self):
         return '<Workflow name: {} active: {}>'.format(self.name, self.active)
@@ -87,17 +153,33 @@ class Workflow(Schedulable, BaseModel):
     ## TODO: remove deactivated tasks from graph ?
     def get_dependencies_graph(self):
         graph = dict()
-        for task in self._tasks:
+        for task in self._tasks.values():
             graph[task.name] = task._dependencies
         return graph
 
+    def get_graph(self):
+        """Returns the compiled WorkflowGraph, compiled once until tasks or dependencies change"""
+        if self._graph == None:
+            self._graph = compile_graph(self.name, self.get_dependencies_graph())
+        return self._graph
+
+    def invalidate_graph(self):
+        self._graph = None
+
+    def add_task(self, task):
+        if task.name in self._tasks:
+            raise Exception('`{}` already added to workflow `{}`'.format(task.name, self.name))
+        ## keep the index of the Taskflow this workflow was added to up to date
+        if self._taskflow != None:
+            self._taskflow.index_task(task)
+        self._tasks[task.name] = task
+        self.invalidate_graph()
+
     def get_tasks(self):
-        return self._tasks
+        return self._tasks.values()
 
     def get_task(self, task_name):
-        for task in self._tasks:
-            if task.name == task_name:
-                return task
+        return self._tasks.get(task_name)
 
     def get_new_instance(self, scheduled=False, status='queued', run_at=None, priority=None, unique=None):
         return WorkflowInstance(
@@ -113,6 +195,8 @@ class Task(Schedulable, BaseModel):
 
     workflow_name = Column(String, ForeignKey('workflows.name'))
 
+    fingerprint_columns = ['name', 'workflow_name']
+
     def __init__(
         self,
         workflow=None,
@@ -124,13 +208,6 @@ class Task(Schedulable, BaseModel):
         *args, **kwargs):
         super(Task, self).__init__(*args, **kwargs)
 
-        self.workflow = workflow
-        if self.workflow:
-            if self in self.workflow._tasks:
-                raise Exception('`{}` already added to workflow `{}`'.format(self.name, self.workflow.name))
-            self.workflow._tasks.add(self)
-            self.workflow_name = workflow.name
-
         self.retries = retries
         self.timeout = timeout
         self.retry_delay = retry_delay
@@ -141,6 +218,11 @@ class Task(Schedulable, BaseModel):
 
         self._dependencies = set()
 
+        self.workflow = workflow
+        if self.workflow:
+            self.workflow_name = workflow.name
+            self.workflow.add_task(self)
+
     def __repr__(self):
         return '<Task name: {} active: {}>'.format(self.name, self.active)
 
@@ -152,6 +234,7 @@ class Task(Schedulable, BaseModel):
         if self.name == task.name:
             raise Exception('A task cannot depend on itself')
         self._dependencies.add(task.name)
+        self.workflow.invalidate_graph()
 
     def get_new_instance(self,
                          scheduled=False,
@@ -179,38 +262,99 @@ class Task(Schedulable, BaseModel):
     def execute(self, task_instance):
         raise NotImplementedError()
 
-    def on_kill(self):
+    def on_kill(self, task_instance_id=None):
+        """Stops a running instance of the task, or every running instance without an id"""
         pass
 
+## numeric ordering of the taskflow_priorities enum, stored on task_instances.priority_rank
+priority_ranks = {
+    'critical': 1,
+    'high': 2,
+    'normal': 3,
+    'low': 4
+}
+
+## statuses a task instance can be pulled from, matches the index_task_instances_pull predicate
+pullable_statuses = ['queued','running','retry']
+
+## statuses covered by the index_unique_<table> partial unique indexes
+unique_statuses = ['queued','pushed','running','retry']
+
+## eligible_at is maintained on every transition:
+##   queued  - run_at
+##   running - locked_at + timeout (the instance can be reclaimed after it times out)
+##   retry   - locked_at + retry_delay
+## so the pull is a range scan on the (priority_rank, eligible_at) partial index
+##
+## Task concurrency is enforced within the same claim. Running counts are kept in
+## concurrency_counts by triggers on task_instances. Slots are assigned before the claim
+## is cut to max_tasks: the counts rows of up to max_tasks tasks with waiting instances
+## are locked FOR UPDATE SKIP LOCKED, in the order of each task's best waiting instance,
+## so concurrent pulls split the tasks between them instead of colliding on the same
+## ones, and cannot oversubscribe a task. Instances are then claimed within their task's
+## available slots. Reclaiming a timed out `running` instance does not take another slot.
 pull_sql = """
-WITH nextTasks as (
-    SELECT id, status, started_at
+WITH eligible AS (
+    SELECT
+        id,
+        task_name,
+        status,
+        priority_rank,
+        eligible_at,
+        row_number() OVER (PARTITION BY task_name, status = 'running'
+                           ORDER BY priority_rank, eligible_at) AS slot
     FROM task_instances
     WHERE
         {}
-        run_at <= :now AND
-        attempts < max_attempts AND
-        (status = 'queued' OR
-          (status = 'running' AND (:now > (locked_at + INTERVAL '1 second' * timeout))) OR
-          (status = 'retry' AND (:now > (locked_at + INTERVAL '1 second' * retry_delay))))
-    ORDER BY
-        CASE WHEN priority = 'critical'
-             THEN 1
-             WHEN priority = 'high'
-             THEN 2
-             WHEN priority = 'normal'
-             THEN 3
-             WHEN priority = 'low'
-             THEN 4
-        END,
-        run_at
+        status IN ('queued','running','retry') AND
+        eligible_at <= :now AND
+        attempts < max_attempts
+),
+slots AS (
+    SELECT
+        concurrency_counts.name,
+        concurrency_counts.concurrency - concurrency_counts.running AS available
+    FROM concurrency_counts
+    JOIN (
+        SELECT task_name, min(priority_rank) AS priority_rank, min(eligible_at) AS eligible_at
+        FROM eligible
+        WHERE status != 'running'
+        GROUP BY task_name
+    ) AS waiting ON waiting.task_name = concurrency_counts.name
+    WHERE
+        concurrency_counts.definition_type = 'task' AND
+        concurrency_counts.concurrency IS NOT NULL AND
+        concurrency_counts.running < concurrency_counts.concurrency
+    ORDER BY waiting.priority_rank, waiting.eligible_at
     LIMIT :max_tasks
-    FOR UPDATE SKIP LOCKED
+    FOR UPDATE OF concurrency_counts SKIP LOCKED
+),
+nextTasks AS (
+    SELECT task_instances.id, task_instances.started_at
+    FROM task_instances
+    JOIN eligible ON eligible.id = task_instances.id
+    LEFT JOIN slots ON slots.name = eligible.task_name
+    WHERE
+        task_instances.status IN ('queued','running','retry') AND
+        task_instances.eligible_at <= :now AND
+        task_instances.attempts < task_instances.max_attempts AND
+        (eligible.status = 'running' OR
+         slots.available >= eligible.slot OR
+         (slots.name IS NULL AND NOT EXISTS (
+            SELECT 1 FROM concurrency_counts
+            WHERE
+                definition_type = 'task' AND
+                name = eligible.task_name AND
+                concurrency IS NOT NULL)))
+    ORDER BY eligible.priority_rank, eligible.eligible_at
+    LIMIT :max_tasks
+    FOR UPDATE OF task_instances SKIP LOCKED
 )
 UPDATE task_instances SET
     status = 'running'::taskflow_statuses,
     worker_id = :worker_id,
     locked_at = :now,
+    eligible_at = :now + (INTERVAL '1 second' * task_instances.timeout),
     started_at = COALESCE(nextTasks.started_at, :now),
     attempts = attempts + 1
 FROM nextTasks
@@ -218,29 +362,71 @@ WHERE task_instances.id = nextTasks.id
 RETURNING task_instances.*;
 """
 
-task_names_filter = '\n       task_instances.name = ANY(:task_names)\n       AND'
+task_names_filter = '\n       task_instances.task_name = ANY(:task_names)\n       AND'
 push_filter = '\n       task_instances.push = true\n       AND'
 
+## every definition with its columns and concurrency limit, for Taskflow.sync_db
+definitions_sql = """
+SELECT definitions.*,
+       concurrency_counts.name IS NOT NULL AS has_limit,
+       concurrency_counts.concurrency
+FROM (
+    SELECT 'workflow' AS definition_type, name, active, NULL AS workflow_name FROM workflows
+    UNION ALL
+    SELECT 'task' AS definition_type, name, active, workflow_name FROM tasks
+) AS definitions
+LEFT JOIN concurrency_counts ON
+    concurrency_counts.definition_type = definitions.definition_type AND
+    concurrency_counts.name = definitions.name
+"""
+
 class Taskflow(object):
-    def __init__(self, monitoring=None):
+    def __init__(self, monitoring=None, advance_workflows_inline=True):
         self._workflows = dict()
-        self._tasks = dict()
+        self._tasks = dict() ## tasks without a workflow
+        self._task_index = dict() ## every task, including workflow tasks, by name
         self._push_workers = dict()
 
         self.monitoring = monitoring or Monitor()
 
+        ## advance a workflow instance as soon as one of its task instances completes,
+        ## instead of waiting for the next scheduler cycle
+        self.advance_workflows_inline = advance_workflows_inline
+
     def set_monitoring(self, monitoring):
         self.monitoring = monitoring
 
+    def check_task_name(self, task):
+        existing = self._task_index.get(task.name)
+        if existing != None and existing is not task:
+            raise Exception('Task `{}` already exists, task names must be unique across workflows'.format(task.name))
+
+    def index_task(self, task):
+        self.check_task_name(task)
+        self._task_index[task.name] = task
+
     def add_workflow(self, workflow):
+        existing = self._workflows.get(workflow.name)
+        if existing != None and existing is not workflow:
+            raise Exception('Workflow `{}` already exists'.format(workflow.name))
+
+        ## validates the dependencies, raising on cycles or unknown tasks
+        workflow.get_graph()
+
+        ## every task is checked before any is indexed, so a conflict leaves the index unchanged
+        for task in workflow.get_tasks():
+            self.check_task_name(task)
+        for task in workflow.get_tasks():
+            self.index_task(task)
         self._workflows[workflow.name] = workflow
+        workflow._taskflow = self
 
     def add_workflows(self, workflows):
         for workflow in workflows:
             self.add_workflow(workflow)
 
     def get_workflow(self, workflow_name):
-        return self._workflows[workflow_name]
+        return self._workflows.get(workflow_name)
 
     def get_workflows(self):
         return self._workflows.values()
@@ -248,6 +434,7 @@ class Taskflow(object):
     def add_task(self, task):
         if task.workflow != None:
             raise Exception('Tasks with workflows are not added individually, just add the workflow')
+        self.index_task(task)
         self._tasks[task.name] = task
 
     def add_tasks(self, tasks):
@@ -255,49 +442,136 @@ class Taskflow(object):
             self.add_task(task)
 
     def get_task(self, task_name):
-        if task_name in self._tasks:
-            return self._tasks[task_name]
-        for workflow in self._workflows.values():
-            task = workflow.get_task(task_name)
-            if task:
-                return task
+        return self._task_index.get(task_name)
 
     def get_tasks(self):
         return self._tasks.values()
 
+    def get_all_tasks(self):
+        """Every task, including workflow tasks"""
+        return self._task_index.values()
+
     def add_push_worker(self, push_worker):
         self._push_workers[push_worker.push_type] = push_worker
 
+    def get_push_workers(self):
+        return self._push_workers.values()
+
     def get_push_worker(self, push_type):
         if push_type not in self._push_workers:
             return None
         return self._push_workers[push_type]
 
-    def sync_tasks(self, session, tasks):
-        for task in tasks:
-            existing = session.query(Task).filter(Task.name == task.name).one_or_none()
-            if existing:
-                task.active = existing.active
-                session.merge(task)
+    def get_definitions(self):
+        """Returns a dict of (definition_type, name) to every Workflow and Task"""
+        definitions = dict()
+        for workflow in self._workflows.values():
+            definitions[('workflow', workflow.name)] = workflow
+            for task in workflow.get_tasks():
+                definitions[('task', task.name)] = task
+        for task in self._tasks.values():
+            definitions[('task', task.name)] = task
+        return definitions
+
+    def sync_definitions(self, session, definitions, changed):
+        """Upserts the workflows and tasks rows of changed definitions, `active` is owned by the database
+           and only written for new rows"""
+        for definition_type, definition_class in [('workflow', Workflow), ('task', Task)]:
+            rows = [definition.get_fingerprint(include_active=True)
+                    for (key_type, name), definition in definitions.items()
+                    if key_type == definition_type and (key_type, name) in changed]
+            if len(rows) == 0:
+                continue
+
+            statement = insert(definition_class.__table__).values(rows)
+            update_columns = set(rows[0].keys()) - set(['name', 'active'])
+            if len(update_columns) > 0:
+                statement = statement.on_conflict_do_update(
+                    index_elements=['name'],
+                    set_=dict((column, getattr(statement.excluded, column)) for column in update_columns))
             else:
-                session.add(task)
+                statement = statement.on_conflict_do_nothing(index_elements=['name'])
+            session.execute(statement)
+
+    def sync_concurrency(self, session, definitions, changed):
+        """Upserts the concurrency limits of definitions with a changed limit to concurrency_counts"""
+        if len(changed) == 0:
+            return
+
+        statement = insert(ConcurrencyCount.__table__).values([
+            {
+                'definition_type': definition_type,
+                'name': name,
+                'concurrency': definitions[(definition_type, name)].concurrency,
+                'running': 0
+            }
+            for definition_type, name in changed])
+        statement = statement.on_conflict_do_update(
+            index_elements=['definition_type', 'name'],
+            set_={'concurrency': statement.excluded.concurrency})
+        session.execute(statement)
 
     def sync_db(self, session, read_only=False):
-        for workflow_name in self._workflows:
-            workflow = self._workflows[workflow_name]
-            existing = session.query(Workflow).filter(Workflow.name == workflow_name).one_or_none()
-            if existing:
-                workflow.active = existing.active
-                session.merge(workflow)
-            else:
-                session.add(workflow)
-
-            self.sync_tasks(session, workflow.get_tasks())
-
-        self.sync_tasks(session, self._tasks.values())
+        """Refreshes the `active` flag of every definition from the database, and writes new or
+           changed definitions and concurrency limits unless read_only. Changes are detected
+           by comparing fingerprints against a single query of all of the definitions."""
+        definitions = self.get_definitions()
+
+        ## a raw query does not autoflush, definitions added to the session must be
+        ## written first or they are seen as new and inserted twice
+        session.flush()
+
+        changed_definitions = set(definitions.keys())
+        changed_limits = set(definitions.keys())
+        for row in session.execute(text(definitions_sql)):
+            key = (row.definition_type, row.name)
+            definition = definitions.get(key)
+            if definition == None:
+                continue
+
+            if definition.active != row.active:
+                definition.active = row.active
+
+            fingerprint = definition.get_fingerprint()
+            if fingerprint == dict((column, row[column]) for column in fingerprint):
+                changed_definitions.discard(key)
+            if row.has_limit and definition.concurrency == row.concurrency:
+                changed_limits.discard(key)
+
+        if read_only:
+            return
+
+        self.sync_definitions(session, definitions, changed_definitions)
+        ## upserting locks the counts rows, which would block pulls until the session ends
+        self.sync_concurrency(session, definitions, changed_limits)
+        session.commit()
 
-        if not read_only:
-            session.commit()
+    def advance_workflow_instance(self, session, workflow_instance_id, now=None):
+        """Queues the next tasks of a running workflow instance, or completes it. The
+           workflow instance row is locked so concurrent completions advance it in turn."""
+        ## imported here, the scheduler depends on this module
+        from .scheduler import Scheduler
+
+        try:
+            workflow_instance = session.query(WorkflowInstance)\
+                .filter(WorkflowInstance.id == workflow_instance_id)\
+                .with_for_update()\
+                .one_or_none()
+
+            if not workflow_instance or workflow_instance.status != 'running':
+                session.rollback()
+                return
+
+            task_instances = session.query(TaskInstance)\
+                .filter(TaskInstance.workflow_instance_id == workflow_instance_id)\
+                .all()
+
+            scheduler = Scheduler(self, now_override=now)
+            scheduler.advance_workflow_instance(session, workflow_instance, task_instances, dict())
+        except Exception:
+            ## the scheduler will advance it on its next cycle
+            logging.getLogger('Taskflow').exception('Exception advancing workflow instance %s', workflow_instance_id)
+            session.rollback()
 
     def pull(self, session, worker_id, task_names=None, max_tasks=1, now=None, push=False):
         if now == None:
@@ -325,6 +599,88 @@ class Taskflow(object):
 
         return task_instances
 
+    def get_next_eligible_at(self, session, task_names=None, now=None, push=False):
+        """Returns the earliest eligible_at after now of the pullable task instances, or None.
+           Lets pull workers sleep until the next task instance is due. Filters as pull_sql does,
+           so workers do not wake for instances that have used up their attempts."""
+        if now == None:
+            now = datetime.utcnow()
+
+        query = session.query(func.min(TaskInstance.eligible_at))\
+            .filter(TaskInstance.status.in_(pullable_statuses),
+                    TaskInstance.eligible_at > now,
+                    TaskInstance.attempts < TaskInstance.max_attempts)
+        if task_names != None:
+            query = query.filter(TaskInstance.task_name.in_(task_names))
+        if push:
+            query = query.filter(TaskInstance.push == True)
+
+        return query.scalar()
+
+    def insert_workflow_instances(self, session, workflow_instances):
+        """Inserts new workflow instances in one multi-row INSERT, skipping any that conflict with an
+           active instance on index_unique_workflow. Returns the ids of the inserted instances."""
+        if len(workflow_instances) == 0:
+            return []
+
+        statement = insert(WorkflowInstance.__table__)\
+            .values([
+                {
+                    'workflow_name': workflow_instance.workflow_name,
+                    'scheduled': workflow_instance.scheduled or False,
+                    'status': workflow_instance.status or 'queued',
+                    'priority': workflow_instance.priority or 'normal',
+                    'run_at': workflow_instance.run_at or datetime.utcnow(),
+                    'params': workflow_instance.params,
+                    'unique': workflow_instance.unique
+                }
+                for workflow_instance in workflow_instances])\
+            .on_conflict_do_nothing(
+                index_elements=['workflow_name', 'unique'],
+                index_where=WorkflowInstance.status.in_(unique_statuses))\
+            .returning(WorkflowInstance.id)
+
+        return [row[0] for row in session.execute(statement)]
+
+    def insert_task_instances(self, session, task_instances):
+        """Inserts new task instances in one multi-row INSERT, skipping any that conflict with an
+           active instance on index_unique_task. Returns the ids of the inserted instances.
+           Core inserts bypass the ORM events, so priority_rank and eligible_at are set here."""
+        if len(task_instances) == 0:
+            return []
+
+        rows = []
+        for task_instance in task_instances:
+            status = task_instance.status or 'queued'
+            priority = task_instance.priority or 'normal'
+            run_at = task_instance.run_at or datetime.utcnow()
+            rows.append({
+                'task_name': task_instance.task_name,
+                'workflow_instance_id': task_instance.workflow_instance_id,
+                'scheduled': task_instance.scheduled or False,
+                'push': task_instance.push,
+                'status': status,
+                'priority': priority,
+                'priority_rank': priority_ranks[priority],
+                'run_at': run_at,
+                'eligible_at': run_at if status == 'queued' else task_instance.eligible_at,
+                'params': task_instance.params or {},
+                'attempts': task_instance.attempts or 0,
+                'max_attempts': task_instance.max_attempts,
+                'timeout': task_instance.timeout,
+                'retry_delay': task_instance.retry_delay,
+                'unique': task_instance.unique
+            })
+
+        statement = insert(TaskInstance.__table__)\
+            .values(rows)\
+            .on_conflict_do_nothing(
+                index_elements=['task_name', 'unique'],
+                index_where=TaskInstance.status.in_(unique_statuses))\
+            .returning(TaskInstance.id)
+
+        return [row[0] for row in session.execute(statement)]
+
 class SchedulableInstance(BaseModel):
     __abstract__ = True
 
@@ -366,6 +722,9 @@ class SchedulableInstance(BaseModel):
         self.status = status
         self.ended_at = now
 
+        if isinstance(self, TaskInstance):
+            self.eligible_at = self.get_eligible_at()
+
         session.commit()
 
         if status == 'success':
@@ -373,6 +732,11 @@ class SchedulableInstance(BaseModel):
         else:
             taskflow.monitoring.task_failed(session, self)
 
+        if isinstance(self, TaskInstance) and \
+            self.workflow_instance_id != None and \
+            taskflow.advance_workflows_inline:
+            taskflow.advance_workflow_instance(session, self.workflow_instance_id, now=now)
+
     def succeed(self, session, taskflow, now=None):
         self.complete(session, taskflow, 'success', now=now)
 
@@ -383,6 +747,7 @@ class SchedulableInstance(BaseModel):
         if isinstance(self, TaskInstance) and self.attempts < self.max_attempts:
             self.status = 'retry'
             self.locked_at = now
+            self.eligible_at = self.get_eligible_at()
 
             if not dry_run:
                 session.commit()
@@ -415,7 +780,11 @@ class WorkflowInstance(SchedulableInstance):
                   cls.unique,
                   unique=True,
                   postgresql_where=
-                    cls.status.in_(['queued','pushed','running','retry']))
+                    cls.status.in_(unique_statuses))
+        Index('index_workflow_instances_recurring',
+                  cls.workflow_name,
+                  cls.scheduled,
+                  cls.run_at.desc())
 
 class TaskInstance(SchedulableInstance):
     __tablename__ = 'task_instances'
@@ -424,6 +793,8 @@ class TaskInstance(SchedulableInstance):
     workflow_instance_id = Column(BigInteger, ForeignKey('workflow_instances.id', ondelete='CASCADE'))
     push = Column(Boolean, nullable=False)
     locked_at = Column(DateTime) ## TODO: should workflow instaces have locked_at as well ?
+    eligible_at = Column(DateTime) ## when the instance can next be pulled, see pull_sql
+    priority_rank = Column(SmallInteger, nullable=False) ## priority_ranks[priority], for index ordering
     worker_id = Column(String)
     params = Column(JSONB, default={})
     push_state = Column(JSONB)
@@ -439,6 +810,18 @@ class TaskInstance(SchedulableInstance):
                     self.workflow_instance_id,
                     self.status)
 
+    def get_eligible_at(self):
+        """Returns when the instance can next be pulled given its status, None if never"""
+        if self.status in [None, 'queued']:
+            return self.run_at
+        if self.locked_at == None:
+            return None
+        if self.status == 'running':
+            return self.locked_at + timedelta(seconds=self.timeout)
+        if self.status == 'retry':
+            return self.locked_at + timedelta(seconds=self.retry_delay)
+        return None
+
     @classmethod
     def build_indexes(cls):
         Index('index_unique_task',
@@ -446,7 +829,144 @@ class TaskInstance(SchedulableInstance):
                   cls.unique,
                   unique=True,
                   postgresql_where=
-                    cls.status.in_(['queued','pushed','running','retry']))
+                    cls.status.in_(unique_statuses))
+        Index('index_task_instances_recurring',
+                  cls.task_name,
+                  cls.scheduled,
+                  cls.run_at.desc())
+        Index('index_task_instances_pull',
+                  cls.priority_rank,
+                  cls.eligible_at,
+                  postgresql_where=
+                    cls.status.in_(pullable_statuses))
+
+@listens_for(TaskInstance, 'before_insert')
+def receive_task_instance_before_insert(mapper, connection, target):
+    if target.run_at == None:
+        target.run_at = datetime.utcnow()
+    if target.priority == None:
+        target.priority = 'normal'
+    target.priority_rank = priority_ranks[target.priority]
+    if target.eligible_at == None:
+        target.eligible_at = target.get_eligible_at()
+
+@listens_for(TaskInstance, 'before_update')
+def receive_task_instance_before_update(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.priority.history.has_changes():
+        target.priority_rank = priority_ranks[target.priority]
+    if target.status == 'queued' and state.attrs.run_at.history.has_changes():
+        target.eligible_at = target.run_at
+
+## pull workers LISTEN on this channel, the payload is the task_name
+task_instances_channel = 'taskflow_task_instances'
+
+## NOTIFY when a task instance is inserted, or transitions, into a pullable waiting status
+task_instances_notify_sql = """
+CREATE OR REPLACE FUNCTION taskflow_notify_task_instance() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('taskflow_task_instances', NEW.task_name);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER task_instances_notify_insert
+    AFTER INSERT ON task_instances
+    FOR EACH ROW
+    WHEN (NEW.status IN ('queued','retry'))
+    EXECUTE PROCEDURE taskflow_notify_task_instance();
+
+CREATE TRIGGER task_instances_notify_update
+    AFTER UPDATE OF status ON task_instances
+    FOR EACH ROW
+    WHEN (NEW.status IN ('queued','retry') AND OLD.status IS DISTINCT FROM NEW.status)
+    EXECUTE PROCEDURE taskflow_notify_task_instance();
+"""
+
+listen(TaskInstance.__table__, 'after_create', DDL(task_instances_notify_sql))
+
+class ConcurrencyCount(BaseModel):
+    """Number of running instances of each Workflow and Task, maintained by triggers,
+       along with the definition's concurrency limit, NULL is unlimited"""
+    __tablename__ = 'concurrency_counts'
+
+    definition_type = Column(String, primary_key=True) ## 'workflow' or 'task'
+    name = Column(String, primary_key=True)
+    concurrency = Column(Integer)
+    running = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<ConcurrencyCount {}: {} running: {} concurrency: {}>'.format(
+                    self.definition_type,
+                    self.name,
+                    self.running,
+                    self.concurrency)
+
+## task instances count as running while `pushed` or `running`, workflow instances while `running`
+task_instances_count_sql = """
+CREATE OR REPLACE FUNCTION taskflow_count_running_tasks() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        IF (OLD.status IN ('pushed','running')) = (NEW.status IN ('pushed','running')) THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+    IF TG_OP IN ('UPDATE','DELETE') THEN
+        IF OLD.status IN ('pushed','running') THEN
+            UPDATE concurrency_counts SET running = GREATEST(running - 1, 0)
+            WHERE definition_type = 'task' AND name = OLD.task_name;
+        END IF;
+    END IF;
+    IF TG_OP IN ('INSERT','UPDATE') THEN
+        IF NEW.status IN ('pushed','running') THEN
+            INSERT INTO concurrency_counts (definition_type, name, running)
+            VALUES ('task', NEW.task_name, 1)
+            ON CONFLICT (definition_type, name) DO UPDATE SET running = concurrency_counts.running + 1;
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER task_instances_count_running
+    AFTER INSERT OR UPDATE OF status OR DELETE ON task_instances
+    FOR EACH ROW
+    EXECUTE PROCEDURE taskflow_count_running_tasks();
+"""
+
+workflow_instances_count_sql = """
+CREATE OR REPLACE FUNCTION taskflow_count_running_workflows() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        IF (OLD.status = 'running') = (NEW.status = 'running') THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+    IF TG_OP IN ('UPDATE','DELETE') THEN
+        IF OLD.status = 'running' THEN
+            UPDATE concurrency_counts SET running = GREATEST(running - 1, 0)
+            WHERE definition_type = 'workflow' AND name = OLD.workflow_name;
+        END IF;
+    END IF;
+    IF TG_OP IN ('INSERT','UPDATE') THEN
+        IF NEW.status = 'running' THEN
+            INSERT INTO concurrency_counts (definition_type, name, running)
+            VALUES ('workflow', NEW.workflow_name, 1)
+            ON CONFLICT (definition_type, name) DO UPDATE SET running = concurrency_counts.running + 1;
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER workflow_instances_count_running
+    AFTER INSERT OR UPDATE OF status OR DELETE ON workflow_instances
+    FOR EACH ROW
+    EXECUTE PROCEDURE taskflow_count_running_workflows();
+"""
+
+listen(TaskInstance.__table__, 'after_create', DDL(task_instances_count_sql))
+listen(WorkflowInstance.__table__, 'after_create', DDL(workflow_instances_count_sql))
 
 class TaskflowEvent(BaseModel):
     __tablename__ = 'taskflow_events'
@@ -1,11 +1,16 @@
-from datetime import datetime
-from itertools import groupby
+from datetime import datetime, timedelta
 import logging
 
 from .models import Workflow, WorkflowInstance, TaskInstance
 
 class Pusher(object):
-    def __init__(self, taskflow, dry_run=None, now_override=None):
+    def __init__(self,
+                 taskflow,
+                 dry_run=None,
+                 now_override=None,
+                 max_tasks=100,
+                 sync_page_size=1000,
+                 reconcile_interval=0):
         self.logger = logging.getLogger('Pusher')
 
         self.taskflow = taskflow
@@ -13,6 +18,20 @@ class Pusher(object):
         self.dry_run = dry_run
         self.now_override = now_override
 
+        ## task instances pulled and pushed per batch, batches are pushed until the queue is drained
+        self.max_tasks = max_tasks
+
+        ## pushed task instances synced per page
+        self.sync_page_size = sync_page_size
+
+        ## task name -> push destination
+        self.push_destinations = dict()
+
+        ## seconds between polling the states of destinations with a state event source, the
+        ## events keep their states current and polling only reconciles missed events
+        self.reconcile_interval = reconcile_interval
+        self.reconciled_at = None
+
     def now(self):
         """Allows for dry runs and tests to use a specific datetime as now"""
         if self.now_override:
@@ -20,36 +39,100 @@ class Pusher(object):
         return datetime.utcnow()
 
     def get_push_destination(self, task_instance):
-        return self.taskflow.get_task(task_instance.task_name).push_destination
-
-    def sync_task_states(self, session):
-        ## TODO: paginate?
-        task_instances = session.query(TaskInstance)\
-            .filter(TaskInstance.push == True, TaskInstance.status.in_(['pushed','running'])).all()
-
-        for push_destination, task_instances in groupby(task_instances, self.get_push_destination):
-            self.logger.info('Syncing states with %s', push_destination)
+        task_name = task_instance.task_name
+        if task_name not in self.push_destinations:
+            self.push_destinations[task_name] = self.taskflow.get_task(task_name).push_destination
+        return self.push_destinations[task_name]
+
+    def partition_by_destination(self, task_instances):
+        """Returns a dict of push destination -> task instances, keeping their order within each destination"""
+        batches = dict()
+        for task_instance in task_instances:
+            batches.setdefault(self.get_push_destination(task_instance), []).append(task_instance)
+        return batches
+
+    def has_event_source(self, push_destination):
+        push_worker = self.taskflow.get_push_worker(push_destination)
+        return push_worker != None and push_worker.event_source != None
+
+    def consume_state_events(self, session):
+        """Applies the state change events of push workers with an event source"""
+        for push_worker in self.taskflow.get_push_workers():
+            if push_worker.event_source == None:
+                continue
 
             try:
-                push_worker = self.taskflow.get_push_worker(push_destination)
-                push_worker.sync_task_instance_states(session, self.dry_run, task_instances, self.now())
+                count = push_worker.consume_state_events(session, self.dry_run, self.now())
+                self.logger.info('Applied %s state events from %s', count, push_worker.push_type)
             except Exception:
-                ## TODO: rollback?
-                self.logger.exception('Exception syncing with %s', push_destination)
+                self.logger.exception('Exception applying state events from %s', push_worker.push_type)
+                session.rollback()
+
+    def sync_task_states(self, session, reconcile=True):
+        """Syncs the states of pushed task instances with their push destinations, a keyset page at a time.
+           Without reconcile, destinations with a state event source are skipped."""
+        filters = [TaskInstance.push == True,
+                   TaskInstance.status.in_(['pushed','running'])]
+        if not reconcile:
+            task_names = [task.name for task in self.taskflow.get_all_tasks()
+                          if task.push_destination != None and not self.has_event_source(task.push_destination)]
+            if len(task_names) == 0:
+                return
+            filters.append(TaskInstance.task_name.in_(task_names))
+
+        last_id = 0
+        while True:
+            task_instances = session.query(TaskInstance)\
+                .filter(TaskInstance.id > last_id, *filters)\
+                .order_by(TaskInstance.id)\
+                .limit(self.sync_page_size)\
+                .all()
+
+            if len(task_instances) == 0:
+                break
+            last_id = task_instances[-1].id
+
+            for push_destination, task_instances_batch in self.partition_by_destination(task_instances).items():
+                self.logger.info('Syncing %s states with %s', len(task_instances_batch), push_destination)
+                self.taskflow.monitoring.push_batch(session, push_destination, 'sync', len(task_instances_batch))
+
+                try:
+                    push_worker = self.taskflow.get_push_worker(push_destination)
+                    push_worker.sync_task_instance_states(session, self.dry_run, task_instances_batch, self.now())
+                except Exception:
+                    self.logger.exception('Exception syncing with %s', push_destination)
+                    session.rollback()
+
+            if len(task_instances) < self.sync_page_size:
+                break
 
 
     def push_queued_task_instances(self, session):
-        task_instances = self.taskflow.pull(session, 'Pusher', max_tasks=100, now=self.now(), push=True)
-
-        for push_destination, task_instances in groupby(task_instances, self.get_push_destination):
-            self.logger.info('Pushing to %s', push_destination)
-
+        while True:
+            task_instances = self.taskflow.pull(session, 'Pusher', max_tasks=self.max_tasks, now=self.now(), push=True)
+
+            for push_destination, task_instances_batch in self.partition_by_destination(task_instances).items():
+                self.logger.info('Pushing %s to %s', len(task_instances_batch), push_destination)
+                self.taskflow.monitoring.push_batch(session, push_destination, 'push', len(task_instances_batch))
+
+                try:
+                    push_worker = self.taskflow.get_push_worker(push_destination)
+                    push_worker.push_task_instances(session, self.dry_run, task_instances_batch)
+                except Exception:
+                    ## TODO: rollback?
+                    self.logger.exception('Exception pushing to %s', push_destination)
+
+            ## a dry run does not claim the pulled task instances, they would be pulled again
+            if self.dry_run or len(task_instances) < self.max_tasks:
+                break
+
+    def close(self):
+        """Closes the push workers, call when the Pusher exits"""
+        for push_worker in self.taskflow.get_push_workers():
             try:
-                push_worker = self.taskflow.get_push_worker(push_destination)
-                push_worker.push_task_instances(session, self.dry_run, task_instances)
+                push_worker.close()
             except Exception:
-                ## TODO: rollback?
-                self.logger.exception('Exception pushing to %s', push_destination)
+                self.logger.exception('Exception closing %s', push_worker.push_type)
 
     def run(self, session):
         self.logger.info('*** Starting Pusher Run ***')
@@ -57,7 +140,16 @@ class Pusher(object):
         self.logger.info('Pushing queued task instances')
         self.push_queued_task_instances(session)
 
+        self.logger.info('Applying pushed task instance state events')
+        self.consume_state_events(session)
+
+        now = self.now()
+        reconcile = self.reconciled_at == None or \
+                    now >= self.reconciled_at + timedelta(seconds=self.reconcile_interval)
+
         self.logger.info('Syncing pushed task instance states')
-        self.sync_task_states(session)
+        self.sync_task_states(session, reconcile=reconcile)
+        if reconcile:
+            self.reconciled_at = now
 
         self.logger.info('*** End Pusher Run ***')
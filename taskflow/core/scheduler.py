@@ -1,13 +1,99 @@
-from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import heapq
 import logging
 
-from toposort import toposort
-from sqlalchemy import or_, and_
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import or_, and_, text
 
-from .models import Workflow, WorkflowInstance, Task, TaskInstance
+from .models import Workflow, WorkflowInstance, Task, TaskInstance, ConcurrencyCount
+
+## the most recent scheduled instance for each name, one index lookup per name
+## on the index_<table>_recurring (name, scheduled, run_at DESC) indexes
+most_recent_sql = """
+SELECT most_recent.*
+FROM unnest(:names) AS names(name)
+CROSS JOIN LATERAL (
+    SELECT * FROM {table}
+    WHERE {name_column} = names.name AND scheduled = true
+    ORDER BY run_at DESC
+    LIMIT 1) AS most_recent
+"""
+
+## advisory lock key held by the leading scheduler, 'tskf' in ascii
+leader_lock_key = 0x74736b66
+
+class LeaderLock(object):
+    """Elects one leader among schedulers sharing a database, using a session level Postgres
+       advisory lock held on a dedicated connection. The lock is released by Postgres when the
+       leader's connection closes, and a standby acquires it on its next attempt."""
+
+    def __init__(self, engine, key=leader_lock_key):
+        self.logger = logging.getLogger('LeaderLock')
+
+        self.engine = engine
+        self.key = key
+        self.connection = None
+
+    def close(self):
+        if self.connection != None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def acquire(self):
+        """Returns True if this process is the leader. The leader pings its connection to make
+           sure the lock is still held, standbys try to take the lock."""
+        if self.connection != None:
+            try:
+                cursor = self.connection.cursor()
+                cursor.execute('SELECT 1;')
+                cursor.close()
+                return True
+            except Exception:
+                self.logger.exception('Lost leader lock connection')
+                self.close()
+
+        try:
+            ## detached from the engine's pool, so no session or other LeaderLock can check out
+            ## the connection holding the lock, and closing it closes the Postgres session
+            self.connection = self.engine.raw_connection()
+            self.connection.detach()
+            self.connection.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT pg_try_advisory_lock(%s);', (self.key,))
+            acquired = cursor.fetchone()[0]
+            cursor.close()
+        except Exception:
+            self.logger.exception('Exception acquiring leader lock')
+            self.close()
+            return False
+
+        if not acquired:
+            self.close()
+            return False
+
+        self.logger.info('Acquired leader lock')
+        return True
+
+    def release(self):
+        if self.connection != None:
+            self.logger.info('Releasing leader lock')
+        self.close()
 
 class Scheduler(object):
-    def __init__(self, taskflow, dry_run=False, now_override=None):
+    def __init__(self,
+                 taskflow,
+                 dry_run=False,
+                 now_override=None,
+                 rebuild_interval=300,
+                 page_size=500,
+                 advance_threads=1,
+                 session_factory=None,
+                 lookahead=0):
         self.logger = logging.getLogger('Scheduler')
 
         self.taskflow = taskflow
@@ -15,6 +101,27 @@ class Scheduler(object):
         self.dry_run = dry_run
         self.now_override = now_override
 
+        ## number of workflow instances advanced per query and commit
+        self.page_size = page_size
+
+        ## workflow instances are advanced on advance_threads threads, each with a
+        ## session from session_factory, if both are set
+        self.advance_threads = advance_threads
+        self.session_factory = session_factory
+
+        ## seconds ahead of run_at that workflow instances are started. Their first tasks are
+        ## queued with the workflow instance's run_at, so workers claim them the moment it passes
+        self.lookahead = lookahead
+
+        ## min-heaps of (due_at, name) per definition class, so each cycle only
+        ## looks at recurring items that are due. Rebuilt when the recurring
+        ## definitions change, or every rebuild_interval seconds to pick up
+        ## changes made to the database outside of the scheduler
+        self.rebuild_interval = rebuild_interval
+        self.recurring_heaps = dict()
+        self.recurring_signatures = dict()
+        self.recurring_built_at = dict()
+
     def now(self):
         """Allows for dry runs and tests to use a specific datetime as now"""
         if self.now_override:
@@ -32,86 +139,97 @@ class Scheduler(object):
         self.logger.info('Queuing task: %s %s', task.name, run_at)
 
         if not self.dry_run:
-            session.add(task_instance)
+            ids = self.taskflow.insert_task_instances(session, [task_instance])
+            if len(ids) == 0:
+                self.logger.info('Task %s already queued for %s', task.name, run_at)
             session.commit()
 
     def queue_workflow_task(self, session, workflow, task_name, workflow_instance, run_at=None):
+        """Returns a new task instance for a workflow task, inserted by queue_workflow_tasks"""
         if run_at == None:
-            run_at = self.now()
+            ## workflow instances started within the lookahead run their tasks at their run_at
+            run_at = max(self.now(), workflow_instance.run_at)
 
         task = workflow.get_task(task_name)
 
+        ## unique per workflow instance, so instances of the same workflow advanced
+        ## in the same cycle do not collide on index_unique_task
         task_instance = task.get_new_instance(
             scheduled=True,
             run_at=run_at,
             workflow_instance_id=workflow_instance.id,
             priority=workflow_instance.priority or workflow.default_priority,
-            unique='scheduled_' + run_at.isoformat())
+            unique='workflow_instance_{}'.format(workflow_instance.id))
 
         self.logger.info('Queuing workflow task: %s %s %s', workflow.name, task.name, run_at)
-        
-        if not self.dry_run:
-            session.add(task_instance)
 
-    def queue_workflow_tasks(self, session, workflow_instance):
+        return task_instance
+
+    def queue_workflow_tasks(self, session, workflow_instance, task_instances=None, commit=True, new_task_instances=None):
+        """Queues the tasks of a workflow instance that are ready to run, and fails or succeeds
+           the workflow instance once it is done. Returns the new status if it is done.
+           task_instances - the instance's task instances, queried if not passed
+           commit - commit and send monitoring if the workflow instance is done
+           new_task_instances - list to collect the new task instances in, for the caller to
+                                insert in bulk. Inserted immediately if not passed"""
         workflow = self.taskflow.get_workflow(workflow_instance.workflow_name)
-        dep_graph = workflow.get_dependencies_graph()
-        dep_graph = list(toposort(dep_graph))
+        graph = workflow.get_graph()
 
-        results = session.query(TaskInstance)\
-                    .filter(TaskInstance.workflow_instance_id == workflow_instance.id).all()
+        if task_instances == None:
+            task_instances = session.query(TaskInstance)\
+                .filter(TaskInstance.workflow_instance_id == workflow_instance.id).all()
         workflow_task_instances = dict()
-        for instance in results:
+        for instance in task_instances:
             workflow_task_instances[instance.task_name] = instance
 
-        ## dep_graph looks like [{'task2', 'task1'}, {'task3'}, {'task4'}]
-        ## a list of sets where each set is a parallel step
-        total_complete_steps = 0
-        failed = False
-        for step in dep_graph:
-            total_in_step = len(step)
-            total_complete = 0
-            tasks_to_queue = []
-
-            for task_name in step:
-                if task_name in workflow_task_instances:
-                    if workflow_task_instances[task_name].status == 'success':
-                        total_complete += 1
-                    elif workflow_task_instances[task_name].status == 'failed':
-                        failed = True
-                        break
-                else:
-                    tasks_to_queue.append(task_name)
-
-            if failed:
-                break
-
-            if not self.dry_run:
-                for task_name in tasks_to_queue:
-                    self.queue_workflow_task(session, workflow, task_name, workflow_instance)
-
-            if len(tasks_to_queue) > 0 and total_complete == total_in_step:
-                raise Exception('Attempting to queue tasks for a completed workflow step')
+        def succeeded(task_name):
+            return task_name in workflow_task_instances and \
+                workflow_task_instances[task_name].status == 'success'
 
-            if total_complete < total_in_step:
-                break
+        ## each task is ready as soon as all of its own dependencies succeed,
+        ## independent of unrelated branches of the graph
+        total_success = 0
+        failed = False
+        tasks_to_queue = []
+        for task_name in graph.order:
+            if task_name in workflow_task_instances:
+                if workflow_task_instances[task_name].status == 'success':
+                    total_success += 1
+                elif workflow_task_instances[task_name].status == 'failed':
+                    failed = True
+            elif all(map(succeeded, graph.dependencies[task_name])):
+                tasks_to_queue.append(task_name)
+
+        if not failed and not self.dry_run and len(tasks_to_queue) > 0:
+            queued = [self.queue_workflow_task(session, workflow, task_name, workflow_instance)
+                      for task_name in tasks_to_queue]
+            if new_task_instances != None:
+                new_task_instances += queued
             else:
-                total_complete_steps += 1
+                self.taskflow.insert_task_instances(session, queued)
 
         if failed:
             workflow_instance.status = 'failed'
             workflow_instance.ended_at = self.now()
             self.logger.info('Workflow {} - {} failed'.format(workflow_instance.workflow_name, workflow_instance.id))
-            if not self.dry_run:
-                session.commit()
-                self.taskflow.monitoring.workflow_failed(session, workflow_instance)
-        elif total_complete_steps == len(dep_graph):
+        elif total_success == len(graph.order):
             workflow_instance.status = 'success'
             workflow_instance.ended_at = self.now()
             self.logger.info('Workflow {} - {} succeeded'.format(workflow_instance.workflow_name, workflow_instance.id))
-            if not self.dry_run:
-                session.commit()
-                self.taskflow.monitoring.workflow_success(session, workflow_instance)
+        else:
+            return None
+
+        if commit and not self.dry_run:
+            session.commit()
+            self.send_workflow_monitoring(session, workflow_instance)
+
+        return workflow_instance.status
+
+    def send_workflow_monitoring(self, session, workflow_instance):
+        if workflow_instance.status == 'failed':
+            self.taskflow.monitoring.workflow_failed(session, workflow_instance)
+        elif workflow_instance.status == 'success':
+            self.taskflow.monitoring.workflow_success(session, workflow_instance)
 
     def queue_workflow(self, session, workflow, run_at):
         workflow_instance = workflow.get_new_instance(
@@ -121,15 +239,109 @@ class Scheduler(object):
 
         self.logger.info('Queuing workflow: %s', workflow.name)
 
+        ## started by advance_workflows_forward, which runs after schedule_recurring
         if not self.dry_run:
             session.add(workflow_instance)
-        
-        if workflow_instance.run_at <= self.now():
-            self.queue_workflow_tasks(session, workflow_instance)
-        
-        if not self.dry_run:
             session.commit()
 
+    def get_fire_times(self, item, start_date, end_date):
+        """Returns every scheduled run of a recurring Workflow or Task from start_date through
+           end_date, within the item's own start_date and end_date"""
+        if item.start_date and item.start_date > start_date:
+            start_date = item.start_date
+        if item.end_date and item.end_date < end_date:
+            end_date = item.end_date
+
+        fire_times = []
+        ## next_run is strictly after its base_time
+        run_at = item.next_run(base_time=start_date - timedelta(seconds=1))
+        while run_at <= end_date:
+            fire_times.append(run_at)
+            run_at = item.next_run(base_time=run_at)
+        return fire_times
+
+    def backfill(self, session, item, start_date, end_date, priority=None, batch_size=1000):
+        """Queues every scheduled run of a recurring Workflow or Task from start_date through
+           end_date, in bulk. Runs that already have an active instance are skipped, using the same
+           unique keys as schedule_recurring. How many run at once is capped by the definition's
+           concurrency. Returns the number of instances queued."""
+        if item.schedule == None:
+            raise Exception('`{}` does not have a schedule to backfill'.format(item.name))
+        if isinstance(item, Task) and item.workflow != None:
+            raise Exception('Backfill the workflow of `{}` instead'.format(item.name))
+
+        fire_times = self.get_fire_times(item, start_date, end_date)
+        self.logger.info('Backfilling %s runs of %s', len(fire_times), item.name)
+
+        queued = 0
+        for i in range(0, len(fire_times), batch_size):
+            instances = []
+            for run_at in fire_times[i:i + batch_size]:
+                instances.append(item.get_new_instance(
+                    scheduled=True,
+                    run_at=run_at,
+                    priority=priority or item.default_priority,
+                    unique='scheduled_' + run_at.isoformat()))
+
+            if self.dry_run:
+                continue
+
+            if isinstance(item, Workflow):
+                ids = self.taskflow.insert_workflow_instances(session, instances)
+            else:
+                ids = self.taskflow.insert_task_instances(session, instances)
+            session.commit()
+            queued += len(ids)
+
+        return queued
+
+    def get_most_recent_instances(self, session, instance_class, names):
+        """Returns a dict of name to the most recent scheduled instance, in one query"""
+        if len(names) == 0:
+            return dict()
+
+        if instance_class == WorkflowInstance:
+            name_column = 'workflow_name'
+        else:
+            name_column = 'task_name'
+
+        sql = most_recent_sql.format(table=instance_class.__tablename__, name_column=name_column)
+        instances = session.query(instance_class)\
+            .from_statement(text(sql))\
+            .params(names=list(names))\
+            .all()
+
+        return dict((getattr(instance, name_column), instance) for instance in instances)
+
+    def get_due_items(self, definition_class, recurring_items, now):
+        """Pops the recurring items that are due off of the timer heap"""
+        signature = frozenset((item.name, item.schedule, item.jitter, item.start_date, item.end_date)
+                              for item in recurring_items)
+        built_at = self.recurring_built_at.get(definition_class)
+
+        if self.recurring_signatures.get(definition_class) != signature or \
+            built_at == None or \
+            (now - built_at).total_seconds() >= self.rebuild_interval:
+            self.logger.info('Building %s timer heap', definition_class.__name__.lower())
+            heap = [(now, item.name) for item in recurring_items]
+            heapq.heapify(heap)
+            self.recurring_heaps[definition_class] = heap
+            self.recurring_signatures[definition_class] = signature
+            self.recurring_built_at[definition_class] = now
+
+        heap = self.recurring_heaps[definition_class]
+        items = dict((item.name, item) for item in recurring_items)
+
+        due_items = []
+        while len(heap) > 0 and heap[0][0] <= now:
+            due_at, name = heapq.heappop(heap)
+            due_items.append(items[name])
+        return due_items
+
+    def schedule_check(self, definition_class, item, due_at):
+        """Pushes a recurring item back on the timer heap, to be checked again at due_at"""
+        heapq.heappush(self.recurring_heaps[definition_class], (due_at, item.name))
+
     def schedule_recurring(self, session, definition_class):
         """Schedules recurring Workflows or Tasks
            definition_class - Workflow or Task"""
@@ -146,25 +358,23 @@ class Scheduler(object):
         now = self.now()
 
         ## get Workflows or Tasks from Taskflow instance
-        recurring_items = filter(lambda item: item.active == True and item.schedule != None,
-                                 recurring_items)
+        recurring_items = list(filter(lambda item: item.active == True and item.schedule != None,
+                                      recurring_items))
+
+        due_items = self.get_due_items(definition_class, recurring_items, now)
+
+        ## Get the most recent instance of every due recurring item
+        ## TODO: order by started_at instead ?
+        most_recent_instances = self.get_most_recent_instances(
+            session,
+            instance_class,
+            [item.name for item in due_items])
 
-        for item in recurring_items:
+        for item in due_items:
             self.logger.info('Scheduling recurring %s: %s', definition_class.__name__.lower(), item.name)
 
             try:
-                if definition_class == Workflow:
-                    filters = (instance_class.workflow_name == item.name,)
-                else:
-                    filters = (instance_class.task_name == item.name,)
-                filters += (instance_class.scheduled == True,)
-
-                ## Get the most recent instance of the recurring item
-                ## TODO: order by started_at instead ?
-                most_recent_instance = session.query(instance_class)\
-                                        .filter(*filters)\
-                                        .order_by(instance_class.run_at.desc())\
-                                        .first()
+                most_recent_instance = most_recent_instances.get(item.name)
 
                 if not most_recent_instance or most_recent_instance.status in ['success','failed']:
                     if not most_recent_instance: ## first run
@@ -175,8 +385,13 @@ class Scheduler(object):
                         if last_run > next_run:
                             next_run = last_run
 
-                    if item.start_date and next_run < item.start_date or \
-                        item.end_date and next_run > item.end_date:
+                    if item.start_date and next_run < item.start_date:
+                        self.logger.info('%s is not within its scheduled range', item.name)
+                        self.schedule_check(definition_class, item, item.start_date)
+                        continue
+
+                    if item.end_date and next_run > item.end_date:
+                        ## not checked again until the definitions change
                         self.logger.info('%s is not within its scheduled range', item.name)
                         continue
 
@@ -184,46 +399,185 @@ class Scheduler(object):
                         self.queue_workflow(session, item, next_run)
                     else:
                         self.queue_task(session, item, next_run)
+
+                    ## the new instance cannot complete before it runs
+                    self.schedule_check(definition_class, item, next_run)
+                elif most_recent_instance.run_at > now:
+                    self.schedule_check(definition_class, item, most_recent_instance.run_at)
+                else:
+                    ## in flight, check again next cycle
+                    self.schedule_check(definition_class, item, now)
             except Exception:
                 self.logger.exception('Exception scheduling %s', item.name)
                 session.rollback()
+                self.schedule_check(definition_class, item, now)
+
+    def advance_workflow_instance(self, session, workflow_instance, task_instances, running_counts, commit=True, new_task_instances=None):
+        """Starts a queued workflow instance, if within its workflow's concurrency, or moves a
+           running one forward. Returns the new status if the workflow instance is done."""
+        self.logger.info('Checking %s - %s for advancement', workflow_instance.workflow_name, workflow_instance.id)
+
+        if workflow_instance.status == 'queued':
+            workflow = self.taskflow.get_workflow(workflow_instance.workflow_name)
+            running = running_counts.get(workflow.name, 0)
+            if workflow.concurrency != None and running >= workflow.concurrency:
+                self.logger.info('Workflow %s is at its concurrency limit of %s',
+                                 workflow.name,
+                                 workflow.concurrency)
+                return None
+            running_counts[workflow.name] = running + 1
+
+            workflow_instance.status = 'running'
+            workflow_instance.started_at = max(self.now(), workflow_instance.run_at)
+            self.logger.info('Starting workflow {} - {}'.format(workflow_instance.workflow_name, workflow_instance.id))
+
+        ## TODO: timeout queued workflow instances that have gone an interval past their run_at
+        status = self.queue_workflow_tasks(session,
+                                           workflow_instance,
+                                           task_instances=task_instances,
+                                           commit=commit,
+                                           new_task_instances=new_task_instances)
+        if commit and not self.dry_run:
+            session.commit()
+        return status
+
+    def lock_running_counts(self, session, workflow_names):
+        """Returns the running instance counts of workflows, locking their concurrency_counts rows
+           in name order so concurrent advancers starting instances of the same workflow see
+           each other's starts, without deadlocking"""
+        if len(workflow_names) == 0:
+            return dict()
+
+        return dict(
+            session.query(ConcurrencyCount.name, ConcurrencyCount.running)\
+            .filter(ConcurrencyCount.definition_type == 'workflow',
+                    ConcurrencyCount.name.in_(sorted(workflow_names)))\
+            .order_by(ConcurrencyCount.name)\
+            .with_for_update()\
+            .all())
+
+    def get_start_names(self, workflow_instances):
+        return set(workflow_instance.workflow_name
+                   for workflow_instance in workflow_instances
+                   if workflow_instance.status == 'queued')
+
+    def advance_workflows_page(self, session, workflow_instances):
+        """Advances a page of claimed workflow instances, with one query for all of their task
+           instances, one insert for the newly ready ones and one commit. Falls back to
+           one commit per workflow instance if anything in the page fails."""
+        workflow_instance_ids = [workflow_instance.id for workflow_instance in workflow_instances]
+
+        task_instances = defaultdict(list)
+        results = session.query(TaskInstance)\
+            .filter(TaskInstance.workflow_instance_id.in_(workflow_instance_ids))\
+            .all()
+        for task_instance in results:
+            task_instances[task_instance.workflow_instance_id].append(task_instance)
+
+        try:
+            running_counts = self.lock_running_counts(session, self.get_start_names(workflow_instances))
+            completed = []
+            new_task_instances = []
+            for workflow_instance in workflow_instances:
+                status = self.advance_workflow_instance(
+                    session,
+                    workflow_instance,
+                    task_instances[workflow_instance.id],
+                    running_counts,
+                    commit=False,
+                    new_task_instances=new_task_instances)
+                if status != None:
+                    completed.append(workflow_instance)
 
-    def advance_workflows_forward(self, session):
-        """Moves queued and running workflows forward"""
-        now = self.now()
+            if not self.dry_run:
+                self.taskflow.insert_task_instances(session, new_task_instances)
+                session.commit()
+                for workflow_instance in completed:
+                    self.send_workflow_monitoring(session, workflow_instance)
+            return
+        except Exception:
+            self.logger.exception('Exception advancing workflow instances page, retrying one at a time')
+            session.rollback()
+
+        ## the rollback released the page's locks, each instance is claimed again
+        for workflow_instance_id in workflow_instance_ids:
+            try:
+                claimed = self.claim_workflow_instances(session, [WorkflowInstance.id == workflow_instance_id])
+                if len(claimed) == 0:
+                    continue
+                workflow_instance = claimed[0]
+
+                self.advance_workflow_instance(
+                    session,
+                    workflow_instance,
+                    task_instances[workflow_instance.id],
+                    self.lock_running_counts(session, self.get_start_names([workflow_instance])))
+            except Exception:
+                self.logger.exception('Exception scheduling %s', workflow_instance_id)
+                session.rollback()
 
-        queued_running_workflow_instances = \
-            session.query(WorkflowInstance)\
+    def claim_workflow_instances(self, session, filters, limit=None):
+        """Locks advanceable workflow instances, skipping any locked by another advancer"""
+        query = session.query(WorkflowInstance)\
             .filter(or_(WorkflowInstance.status == 'running',
                         and_(WorkflowInstance.status == 'queued',
-                             WorkflowInstance.run_at <= now)))\
-            .all() ## TODO: paginate?
+                             WorkflowInstance.run_at <= self.now() + timedelta(seconds=self.lookahead))),
+                    *filters)\
+            .order_by(WorkflowInstance.id)
+        if limit != None:
+            query = query.limit(limit)
+        return query.with_for_update(skip_locked=True).all()
+
+    def advance_workflows_forward(self, session, partition=0, partitions=1):
+        """Moves queued and running workflows forward, a page of claimed instances at a time.
+           partition, partitions - only advance instances where id % partitions == partition"""
+        filters = []
+        if partitions > 1:
+            filters.append(WorkflowInstance.id % partitions == partition)
+
+        last_id = 0
+        while True:
+            workflow_instances = self.claim_workflow_instances(
+                session,
+                [WorkflowInstance.id > last_id] + filters,
+                limit=self.page_size)
+
+            if len(workflow_instances) == 0:
+                session.commit()
+                break
+            last_id = workflow_instances[-1].id
 
-        for workflow_instance in queued_running_workflow_instances:
-            self.logger.info('Checking %s - %s for advancement', workflow_instance.workflow_name, workflow_instance.id)
-            try:
-                if workflow_instance.status == 'queued':
-                    workflow_instance.status = 'running'
-                    workflow_instance.started_at = self.now()
-                    self.logger.info('Starting workflow {} - {} failed'.format(workflow_instance.workflow_name, workflow_instance.id))
-                    self.queue_workflow_tasks(session, workflow_instance)
-                    if not self.dry_run:
-                        session.commit()
-                elif workflow_instance.status == 'running':
-                    ## TODO: timeout queued workflow instances that have gone an interval past their run_at
-                    self.queue_workflow_tasks(session, workflow_instance)
-                    if not self.dry_run:
-                        session.commit()
-            except Exception:
-                self.logger.exception('Exception scheduling %s', workflow_instance.workflow_name)
+            self.advance_workflows_page(session, workflow_instances)
+            if self.dry_run:
+                ## releases the page's locks
                 session.rollback()
 
+            if len(workflow_instances) < self.page_size:
+                break
+
+    def advance_workflows_partition(self, partition):
+        session = self.session_factory()
+        try:
+            self.advance_workflows_forward(session, partition=partition, partitions=self.advance_threads)
+        finally:
+            session.close()
+
+    def advance_workflows_parallel(self):
+        """Advances disjoint partitions of the workflow instances on advance_threads threads,
+           each with its own session"""
+        with ThreadPoolExecutor(max_workers=self.advance_threads) as executor:
+            for result in executor.map(self.advance_workflows_partition, range(self.advance_threads)):
+                pass
+
     def fail_timedout_task_instances(self, session):
         ## TODO: return info using RETURNING and log
+        ## submitted push task instances are timed out by their push worker, which
+        ## knows when the job started and stops it, see AWSBatchPushWorker.is_timed_out
         if not self.dry_run:
             session.execute(
                 "UPDATE task_instances SET status = 'failed', ended_at = :now " +
-                "WHERE status in ('running','retry') AND " + 
+                "WHERE status in ('running','retry') AND " +
+                "(push = false OR push_state IS NULL OR push_state = 'null'::jsonb) AND " +
                 "(:now > (locked_at + INTERVAL '1 second' * timeout)) AND " +
                 "attempts >= max_attempts", {'now': self.now()})
 
@@ -240,7 +594,10 @@ class Scheduler(object):
 
         self.logger.info('Advancing workflows')
 
-        self.advance_workflows_forward(session)
+        if self.advance_threads > 1 and self.session_factory != None:
+            self.advance_workflows_parallel()
+        else:
+            self.advance_workflows_forward(session)
 
         ## TODO: start / advance non recurring workflows
 
@@ -0,0 +1,256 @@
+from collections import namedtuple, defaultdict, deque
+from datetime import timedelta
+import heapq
+import logging
+import math
+import random
+
+from .models import Workflow, priority_ranks
+
+## duration distributions, called with a random.Random and return seconds
+
+def constant(seconds):
+    return lambda rng: seconds
+
+def uniform(low, high):
+    return lambda rng: rng.uniform(low, high)
+
+def lognormal(median, sigma):
+    """Long tailed durations, half of the runs take less than median seconds"""
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+def percentile(values, percent):
+    """Nearest rank percentile of a sorted list"""
+    if len(values) == 0:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+## results of a simulation
+##   task_runs - number of task instances run
+##   workflow_runs - number of workflow instances run
+##   start_latency - percentile -> seconds between a task instance being ready and it starting
+##   queue_depth - list of (datetime, number of ready task instances waiting), at every change
+##   peak_queue_depth - largest number of ready task instances waiting at once
+##   peak_running - largest number of task instances running at once
+##   utilization - fraction of the workers' time spent running task instances
+SimulationReport = namedtuple('SimulationReport', [
+    'task_runs',
+    'workflow_runs',
+    'start_latency',
+    'queue_depth',
+    'peak_queue_depth',
+    'peak_running',
+    'utilization'])
+
+class TaskRun(object):
+    def __init__(self, task, priority, run_at, ready_at, workflow_run=None):
+        self.task = task
+        self.priority_rank = priority_ranks[priority]
+        self.run_at = run_at
+        self.ready_at = ready_at
+        self.workflow_run = workflow_run
+        self.started_at = None
+
+class WorkflowRun(object):
+    def __init__(self, workflow, run_at):
+        self.workflow = workflow
+        self.run_at = run_at
+        self.indegrees = dict(workflow.get_graph().indegrees)
+        self.remaining = len(self.indegrees)
+
+class Simulator(object):
+    """Replays the schedules of a Taskflow's recurring Workflows and Tasks in memory, with
+       simulated task durations and a fixed number of workers, following the scheduler's rules:
+       a definition's next run is created when its previous run completes, workflow instances
+       start within their workflow's concurrency, tasks are ready once their dependencies
+       succeed, and workers pull ready tasks by priority then readiness within each task's
+       concurrency. Scheduling and polling delays are not simulated.
+
+       durations - dict of task name to a duration distribution, see constant, uniform and lognormal
+       default_duration - duration distribution of tasks not in durations"""
+
+    def __init__(self, taskflow, workers=1, durations=None, default_duration=constant(60), seed=None):
+        self.logger = logging.getLogger('Simulator')
+
+        self.taskflow = taskflow
+        self.workers = workers
+        self.durations = durations or dict()
+        self.default_duration = default_duration
+        self.random = random.Random(seed)
+
+    def get_duration(self, task):
+        return self.durations.get(task.name, self.default_duration)(self.random)
+
+    def next_run_at(self, item, previous_run_at, now):
+        """When the scheduler would run a recurring item next, given its previous run completed at now"""
+        if previous_run_at == None:
+            run_at = item.next_run(base_time=now)
+        else:
+            run_at = item.next_run(base_time=previous_run_at)
+            last_run = item.last_run(base_time=now)
+            if last_run > run_at:
+                run_at = last_run
+
+        if item.start_date and run_at < item.start_date:
+            run_at = item.next_run(base_time=item.start_date - timedelta(seconds=1))
+        if item.end_date and run_at > item.end_date:
+            return None
+        return run_at
+
+    def run(self, start_date, end_date):
+        """Simulates the runs scheduled from start_date through end_date, and the completion of
+           the runs in flight at end_date. Returns a SimulationReport."""
+        self.events = [] ## heap of (datetime, sequence, handler, args)
+        self.sequence = 0
+
+        self.ready = [] ## heap of (priority_rank, ready_at, sequence, TaskRun)
+        self.blocked = defaultdict(deque) ## task name -> TaskRuns waiting on the task's concurrency
+        self.waiting = 0
+        self.running = 0
+        self.running_tasks = defaultdict(int)
+        self.running_workflows = defaultdict(int)
+        self.queued_workflows = defaultdict(deque)
+
+        self.now = start_date
+        self.end_date = end_date
+        self.latencies = []
+        self.queue_depth = []
+        self.peak_queue_depth = 0
+        self.peak_running = 0
+        self.busy_seconds = 0.0
+        self.task_runs = 0
+        self.workflow_runs = 0
+
+        recurring_items = list(self.taskflow.get_workflows()) + list(self.taskflow.get_tasks())
+        for item in recurring_items:
+            if item.active and item.schedule != None:
+                self.schedule_item(item, None, start_date)
+
+        while len(self.events) > 0:
+            now, _, handler, args = heapq.heappop(self.events)
+            self.now = now
+            handler(now, *args)
+            self.dispatch(now)
+
+        if len(self.latencies) > 0:
+            latencies = sorted(self.latencies)
+            start_latency = dict((percent, percentile(latencies, percent)) for percent in [50, 90, 95, 99, 100])
+        else:
+            start_latency = dict()
+
+        period = max((self.now - start_date).total_seconds(), 1)
+
+        return SimulationReport(
+            task_runs=self.task_runs,
+            workflow_runs=self.workflow_runs,
+            start_latency=start_latency,
+            queue_depth=self.queue_depth,
+            peak_queue_depth=self.peak_queue_depth,
+            peak_running=self.peak_running,
+            utilization=self.busy_seconds / (period * self.workers))
+
+    def push_event(self, at, handler, *args):
+        self.sequence += 1
+        heapq.heappush(self.events, (at, self.sequence, handler, args))
+
+    def schedule_item(self, item, previous_run_at, now):
+        run_at = self.next_run_at(item, previous_run_at, now)
+        if run_at != None and run_at <= self.end_date:
+            self.push_event(max(run_at, now), self.on_due, item, run_at)
+
+    def on_due(self, now, item, run_at):
+        if isinstance(item, Workflow):
+            workflow_run = WorkflowRun(item, run_at)
+            if item.concurrency != None and self.running_workflows[item.name] >= item.concurrency:
+                self.queued_workflows[item.name].append(workflow_run)
+            else:
+                self.start_workflow(now, workflow_run)
+        else:
+            self.queue_task(now, TaskRun(item, item.default_priority, run_at, now))
+
+    def start_workflow(self, now, workflow_run):
+        self.running_workflows[workflow_run.workflow.name] += 1
+        if workflow_run.remaining == 0:
+            self.on_workflow_complete(now, workflow_run)
+            return
+        for task_name in workflow_run.workflow.get_graph().roots:
+            self.queue_workflow_task(now, workflow_run, task_name)
+
+    def queue_workflow_task(self, now, workflow_run, task_name):
+        workflow = workflow_run.workflow
+        self.queue_task(now, TaskRun(workflow.get_task(task_name),
+                                     workflow.default_priority,
+                                     workflow_run.run_at,
+                                     now,
+                                     workflow_run=workflow_run))
+
+    def queue_task(self, now, task_run):
+        self.sequence += 1
+        heapq.heappush(self.ready, (task_run.priority_rank, task_run.ready_at, self.sequence, task_run))
+        self.set_waiting(now, self.waiting + 1)
+
+    def set_waiting(self, now, waiting):
+        self.waiting = waiting
+        self.peak_queue_depth = max(self.peak_queue_depth, waiting)
+        if len(self.queue_depth) > 0 and self.queue_depth[-1][0] == now:
+            self.queue_depth[-1] = (now, waiting)
+        else:
+            self.queue_depth.append((now, waiting))
+
+    def dispatch(self, now):
+        """Starts ready task instances on free workers"""
+        while self.running < self.workers and len(self.ready) > 0:
+            _, _, _, task_run = heapq.heappop(self.ready)
+            task = task_run.task
+            if task.concurrency != None and self.running_tasks[task.name] >= task.concurrency:
+                self.blocked[task.name].append(task_run)
+                continue
+
+            task_run.started_at = now
+            self.latencies.append((now - task_run.ready_at).total_seconds())
+            self.running += 1
+            self.running_tasks[task.name] += 1
+            self.peak_running = max(self.peak_running, self.running)
+            self.set_waiting(now, self.waiting - 1)
+
+            duration = self.get_duration(task)
+            self.busy_seconds += duration
+            self.push_event(now + timedelta(seconds=duration), self.on_task_complete, task_run)
+
+    def on_task_complete(self, now, task_run):
+        task = task_run.task
+        self.task_runs += 1
+        self.running -= 1
+        self.running_tasks[task.name] -= 1
+
+        if len(self.blocked[task.name]) > 0:
+            blocked_run = self.blocked[task.name].popleft()
+            self.sequence += 1
+            heapq.heappush(self.ready, (blocked_run.priority_rank, blocked_run.ready_at, self.sequence, blocked_run))
+
+        workflow_run = task_run.workflow_run
+        if workflow_run == None:
+            self.schedule_item(task, task_run.run_at, now)
+            return
+
+        graph = workflow_run.workflow.get_graph()
+        workflow_run.remaining -= 1
+        for dependent in graph.dependents[task.name]:
+            workflow_run.indegrees[dependent] -= 1
+            if workflow_run.indegrees[dependent] == 0:
+                self.queue_workflow_task(now, workflow_run, dependent)
+
+        if workflow_run.remaining == 0:
+            self.on_workflow_complete(now, workflow_run)
+
+    def on_workflow_complete(self, now, workflow_run):
+        workflow = workflow_run.workflow
+        self.workflow_runs += 1
+        self.running_workflows[workflow.name] -= 1
+
+        if len(self.queued_workflows[workflow.name]) > 0:
+            self.start_workflow(now, self.queued_workflows[workflow.name].popleft())
+
+        self.schedule_item(workflow, workflow_run.run_at, now)
@@ -1,20 +1,42 @@
 import logging
+import multiprocessing
+import os
+import queue
+import resource
+import select
 import signal
 import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from .models import Workflow, WorkflowInstance, Task, TaskInstance
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .models import Workflow, WorkflowInstance, Task, TaskInstance, task_instances_channel
 
 class Worker(object):
     def __init__(self, taskflow):
         self.logger = logging.getLogger('Worker')
         self.taskflow = taskflow
 
+        ## task instance id -> Task, for every task currently executing
+        self.running_tasks = dict()
+        self.running_tasks_lock = threading.Lock()
+
         signal.signal(signal.SIGINT, self.on_kill)
         signal.signal(signal.SIGTERM, self.on_kill)
 
     def on_kill(self, sig_num, stack_frame):
-        if hasattr(self, 'task'):
-            self.task.on_kill()
+        with self.running_tasks_lock:
+            running_tasks = list(self.running_tasks.items())
+        ## instances of the same task share a Task, each instance is killed by its id
+        for task_instance_id, task in running_tasks:
+            try:
+                task.on_kill(task_instance_id)
+            except Exception:
+                self.logger.exception('Exception killing %s %s', task.name, task_instance_id)
         sys.exit(0)
 
     def execute(self, session, task_instance):
@@ -23,11 +45,490 @@ class Worker(object):
             if not task:
                 raise Exception('Task `{}` does not exist'.format(task_instance.task_name))
 
-            self.current_task = task
+            with self.running_tasks_lock:
+                self.running_tasks[task_instance.id] = task
             task.execute(task_instance)
         except Exception:
             self.logger.exception('Error executing: %s %s', task_instance.task_name, task_instance.id)
             task_instance.fail(session, self.taskflow)
             return False
+        finally:
+            with self.running_tasks_lock:
+                self.running_tasks.pop(task_instance.id, None)
         task_instance.succeed(session, self.taskflow)
         return True
+
+    def execute_by_id(self, Session, task_instance_id):
+        """Executes a task instance within its own session"""
+        session = Session()
+        try:
+            task_instance = session.query(TaskInstance).get(task_instance_id)
+            if not task_instance:
+                self.logger.error('Task instance %s does not exist', task_instance_id)
+                return False
+            return self.execute(session, task_instance)
+        finally:
+            session.close()
+
+class WorkerPool(object):
+    """Executes pulled task instances concurrently on a thread pool, each in its own session.
+       Intended for I/O bound tasks, such as BashTask subprocesses."""
+
+    def __init__(self, worker, Session, slots):
+        self.worker = worker
+        self.Session = Session
+        self.slots = slots
+
+        self.executor = ThreadPoolExecutor(max_workers=slots)
+        self.futures = set()
+
+    def free_slots(self):
+        self.futures = set(filter(lambda future: not future.done(), self.futures))
+        return self.slots - len(self.futures)
+
+    def submit(self, task_instance_id):
+        future = self.executor.submit(self.worker.execute_by_id, self.Session, task_instance_id)
+        self.futures.add(future)
+
+    def wait(self, timeout=None):
+        """Blocks until a running task instance finishes, or the timeout passes"""
+        if len(self.futures) > 0:
+            wait(self.futures, timeout=timeout, return_when=FIRST_COMPLETED)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+def get_rss():
+    """Returns the resident set size of the current process in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        ## peak, not current, RSS where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def prefork_child(taskflow, url, task_queue, result_queue, max_tasks_per_child, max_rss):
+    """Entry point of a prefork child process. Executes task instance ids off its own queue
+       until it receives None, or until it should be recycled."""
+    ## the parent's pooled connections must not be shared, use a new engine
+    engine = create_engine(url, pool_size=1)
+    Session = sessionmaker(bind=engine)
+
+    worker = Worker(taskflow)
+    pid = os.getpid()
+
+    tasks_executed = 0
+    while True:
+        task_instance_id = task_queue.get()
+        if task_instance_id == None:
+            break
+
+        try:
+            worker.execute_by_id(Session, task_instance_id)
+        except Exception:
+            worker.logger.exception('Exception executing task instance %s', task_instance_id)
+
+        tasks_executed += 1
+        recycling = False
+        if max_tasks_per_child and tasks_executed >= max_tasks_per_child:
+            worker.logger.info('Recycling child %s after %s tasks', pid, tasks_executed)
+            recycling = True
+        elif max_rss and get_rss() > max_rss:
+            worker.logger.info('Recycling child %s with RSS over %s bytes', pid, max_rss)
+            recycling = True
+
+        ## a recycling child is sent no more work, its slot returns once it is replaced
+        result_queue.put(('finished', pid, task_instance_id, recycling))
+        if recycling:
+            break
+
+    engine.dispose()
+
+class PreforkWorkerPool(object):
+    """Executes pulled task instances on a pool of warm, forked child processes.
+       Intended for CPU bound tasks. The parent only claims work and hands out task
+       instance ids, each child has its own database connection and is replaced after
+       `max_tasks_per_child` tasks or once its RSS is over `max_rss` bytes.
+
+       Each child has its own task queue and executes one task instance at a time, so
+       a slot belongs to a child pid and is reclaimed when the child exits."""
+
+    def __init__(self, taskflow, engine, processes, max_tasks_per_child=None, max_rss=None):
+        self.logger = logging.getLogger('PreforkWorkerPool')
+
+        self.taskflow = taskflow
+        self.url = engine.url
+        self.processes = processes
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_rss = max_rss
+
+        self.context = multiprocessing.get_context('fork')
+        self.result_queue = self.context.Queue()
+
+        self.children = dict() ## pid -> Process
+        self.task_queues = dict() ## pid -> the child's task queue
+        self.child_task_instances = dict() ## pid -> task instance id submitted and not finished
+        self.recycling = set() ## pids of children exiting to be replaced
+
+        for i in range(processes):
+            self.spawn()
+
+        signal.signal(signal.SIGINT, self.on_kill)
+        signal.signal(signal.SIGTERM, self.on_kill)
+
+    def on_kill(self, sig_num, stack_frame):
+        ## children kill their running tasks via Worker.on_kill
+        for child in self.children.values():
+            child.terminate()
+        for child in self.children.values():
+            child.join(timeout=30)
+        sys.exit(0)
+
+    def spawn(self):
+        task_queue = self.context.Queue()
+        child = self.context.Process(
+            target=prefork_child,
+            args=(self.taskflow,
+                  self.url,
+                  task_queue,
+                  self.result_queue,
+                  self.max_tasks_per_child,
+                  self.max_rss))
+        child.daemon = True
+        child.start()
+        self.children[child.pid] = child
+        self.task_queues[child.pid] = task_queue
+
+    def handle_result(self, result):
+        event, pid, task_instance_id, recycling = result
+        if recycling and pid in self.children:
+            self.recycling.add(pid)
+        if event == 'finished' and self.child_task_instances.get(pid) == task_instance_id:
+            del self.child_task_instances[pid]
+
+    def drain_results(self):
+        while True:
+            try:
+                self.handle_result(self.result_queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def reap_children(self):
+        """Replaces children that exited, either recycled or crashed, and reclaims their slots"""
+        exited = [pid for pid, child in self.children.items() if not child.is_alive()]
+        if len(exited) == 0:
+            return
+
+        ## results sent before exiting
+        self.drain_results()
+
+        resubmit = []
+        for pid in exited:
+            child = self.children.pop(pid)
+            child.join()
+            self.recycling.discard(pid)
+            task_queue = self.task_queues.pop(pid)
+
+            if pid in self.child_task_instances:
+                task_instance_id = self.child_task_instances.pop(pid)
+                try:
+                    ## never taken off the child's queue, another child can run it
+                    task_queue.get(timeout=0.1)
+                    self.logger.warning('Child %s exited with code %s before starting task instance %s',
+                                        pid,
+                                        child.exitcode,
+                                        task_instance_id)
+                    resubmit.append(task_instance_id)
+                except queue.Empty:
+                    ## the instance stays `running` and will be retried after it times out
+                    self.logger.error('Child %s exited with code %s while executing task instance %s',
+                                      pid,
+                                      child.exitcode,
+                                      task_instance_id)
+            task_queue.close()
+
+            self.spawn()
+
+        for task_instance_id in resubmit:
+            self.submit(task_instance_id)
+
+    def idle_children(self):
+        return [pid for pid in self.children
+                if pid not in self.child_task_instances and pid not in self.recycling]
+
+    def free_slots(self):
+        self.drain_results()
+        self.reap_children()
+        return len(self.idle_children())
+
+    def submit(self, task_instance_id):
+        idle_children = self.idle_children()
+        if len(idle_children) == 0:
+            raise Exception('No free slot for task instance {}'.format(task_instance_id))
+        pid = idle_children[0]
+        self.child_task_instances[pid] = task_instance_id
+        self.task_queues[pid].put(task_instance_id)
+
+    def wait(self, timeout=None):
+        """Blocks until a slot is free, or the timeout passes"""
+        deadline = None
+        if timeout != None:
+            deadline = time.time() + timeout
+
+        while len(self.idle_children()) == 0:
+            ## recycling children are replaced as soon as they exit
+            poll_timeout = 0.1 if len(self.recycling) > 0 else 1
+            if deadline != None:
+                poll_timeout = min(poll_timeout, deadline - time.time())
+                if poll_timeout <= 0:
+                    break
+            try:
+                self.handle_result(self.result_queue.get(timeout=poll_timeout))
+            except queue.Empty:
+                pass
+            self.reap_children()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+def get_rss():
+    """Returns the resident set size of the current process in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        ## peak, not current, RSS where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def prefork_child(taskflow, url, task_queue, result_queue, max_tasks_per_child, max_rss):
+    """Entry point of a prefork child process. Executes task instance ids off its own queue
+       until it receives None, or until it should be recycled."""
+    ## the parent's pooled connections must not be shared, use a new engine
+    engine = create_engine(url, pool_size=1)
+    Session = sessionmaker(bind=engine)
+
+    worker = Worker(taskflow)
+    pid = os.getpid()
+
+    tasks_executed = 0
+    while True:
+        task_instance_id = task_queue.get()
+        if task_instance_id == None:
+            break
+
+        try:
+            worker.execute_by_id(Session, task_instance_id)
+        except Exception:
+            worker.logger.exception('Exception executing task instance %s', task_instance_id)
+
+        tasks_executed += 1
+        recycling = False
+        if max_tasks_per_child and tasks_executed >= max_tasks_per_child:
+            worker.logger.info('Recycling child %s after %s tasks', pid, tasks_executed)
+            recycling = True
+        elif max_rss and get_rss() > max_rss:
+            worker.logger.info('Recycling child %s with RSS over %s bytes', pid, max_rss)
+            recycling = True
+
+        ## a recycling child is sent no more work, its slot returns once it is replaced
+        result_queue.put(('finished', pid, task_instance_id, recycling))
+        if recycling:
+            break
+
+    engine.dispose()
+
+class PreforkWorkerPool(object):
+    """Executes pulled task instances on a pool of warm, forked child processes.
+       Intended for CPU bound tasks. The parent only claims work and hands out task
+       instance ids, each child has its own database connection and is replaced after
+       `max_tasks_per_child` tasks or once its RSS is over `max_rss` bytes.
+
+       Each child has its own task queue and executes one task instance at a time, so
+       a slot belongs to a child pid and is reclaimed when the child exits."""
+
+    def __init__(self, taskflow, engine, processes, max_tasks_per_child=None, max_rss=None):
+        self.logger = logging.getLogger('PreforkWorkerPool')
+
+        self.taskflow = taskflow
+        self.url = engine.url
+        self.processes = processes
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_rss = max_rss
+
+        self.context = multiprocessing.get_context('fork')
+        self.result_queue = self.context.Queue()
+
+        self.children = dict() ## pid -> Process
+        self.task_queues = dict() ## pid -> the child's task queue
+        self.child_task_instances = dict() ## pid -> task instance id submitted and not finished
+        self.recycling = set() ## pids of children exiting to be replaced
+
+        for i in range(processes):
+            self.spawn()
+
+        signal.signal(signal.SIGINT, self.on_kill)
+        signal.signal(signal.SIGTERM, self.on_kill)
+
+    def on_kill(self, sig_num, stack_frame):
+        ## children kill their running tasks via Worker.on_kill
+        for child in self.children.values():
+            child.terminate()
+        for child in self.children.values():
+            child.join(timeout=30)
+        sys.exit(0)
+
+    def spawn(self):
+        task_queue = self.context.Queue()
+        child = self.context.Process(
+            target=prefork_child,
+            args=(self.taskflow,
+                  self.url,
+                  task_queue,
+                  self.result_queue,
+                  self.max_tasks_per_child,
+                  self.max_rss))
+        child.daemon = True
+        child.start()
+        self.children[child.pid] = child
+        self.task_queues[child.pid] = task_queue
+
+    def handle_result(self, result):
+        event, pid, task_instance_id = result
+        if event == 'finished' and self.child_task_instances.get(pid) == task_instance_id:
+            del self.child_task_instances[pid]
+
+    def drain_results(self):
+        while True:
+            try:
+                self.handle_result(self.result_queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def reap_children(self):
+        """Replaces children that exited, either recycled or crashed, and reclaims their slots"""
+        exited = [pid for pid, child in self.children.items() if not child.is_alive()]
+        if len(exited) == 0:
+            return
+
+        ## results sent before exiting
+        self.drain_results()
+
+        for pid in exited:
+            child = self.children.pop(pid)
+            child.join()
+            self.task_queues.pop(pid).close()
+
+            if pid in self.child_task_instances:
+                ## the instance stays `running` and will be retried after it times out
+                task_instance_id = self.child_task_instances.pop(pid)
+                self.logger.error('Child %s exited with code %s while executing task instance %s',
+                                  pid,
+                                  child.exitcode,
+                                  task_instance_id)
+
+            self.spawn()
+
+    def free_slots(self):
+        self.drain_results()
+        self.reap_children()
+        return self.processes - len(self.child_task_instances)
+
+    def submit(self, task_instance_id):
+        for pid in self.children:
+            if pid not in self.child_task_instances:
+                self.child_task_instances[pid] = task_instance_id
+                self.task_queues[pid].put(task_instance_id)
+                return
+        raise Exception('No free slot for task instance {}'.format(task_instance_id))
+
+    def wait(self, timeout=None):
+        """Blocks until a running task instance finishes, or the timeout passes"""
+        deadline = None
+        if timeout != None:
+            deadline = time.time() + timeout
+
+        in_flight = len(self.child_task_instances)
+        while in_flight > 0 and len(self.child_task_instances) >= in_flight:
+            poll_timeout = 1
+            if deadline != None:
+                poll_timeout = min(poll_timeout, deadline - time.time())
+                if poll_timeout <= 0:
+                    break
+            try:
+                self.handle_result(self.result_queue.get(timeout=poll_timeout))
+            except queue.Empty:
+                self.reap_children()
+
+    def shutdown(self):
+        for task_queue in self.task_queues.values():
+            task_queue.put(None)
+        for child in self.children.values():
+            child.join()
+        self.drain_results()
+
+class TaskInstanceListener(object):
+    """LISTENs for task instances becoming pullable, so pull workers can wake up
+       as soon as work is queued instead of polling on a fixed interval"""
+
+    def __init__(self, engine, task_names=None):
+        self.logger = logging.getLogger('TaskInstanceListener')
+
+        self.engine = engine
+        self.task_names = task_names
+        self.pool_connection = None
+        self.connection = None
+
+    def connect(self):
+        ## detached from the engine's pool, so sessions never check out the autocommit,
+        ## LISTENing connection, and closing it closes the Postgres session
+        self.pool_connection = self.engine.raw_connection()
+        self.pool_connection.detach()
+        self.connection = self.pool_connection.connection
+        self.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = self.connection.cursor()
+        cursor.execute('LISTEN {};'.format(task_instances_channel))
+        cursor.close()
+
+    def close(self):
+        if self.pool_connection != None:
+            try:
+                self.pool_connection.close()
+            except Exception:
+                pass
+            self.pool_connection = None
+            self.connection = None
+
+    def wait(self, timeout):
+        """Waits up to `timeout` seconds for a notification on a relevant task.
+           Returns True if one was received, False on timeout."""
+        deadline = time.time() + timeout
+
+        try:
+            if self.connection == None:
+                self.connect()
+
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+
+                readable, _, _ = select.select([self.connection], [], [], remaining)
+                if not readable:
+                    return False
+
+                self.connection.poll()
+                notified = False
+                while self.connection.notifies:
+                    notify = self.connection.notifies.pop(0)
+                    if self.task_names == None or notify.payload in self.task_names:
+                        notified = True
+                if notified:
+                    return True
+        except Exception:
+            ## fallback to sleeping, reconnect on the next wait
+            self.logger.exception('Exception listening for task instances')
+            self.close()
+            remaining = deadline - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+            return False
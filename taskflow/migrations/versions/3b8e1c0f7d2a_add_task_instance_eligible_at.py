@@ -0,0 +1,54 @@
+"""add task instance eligible_at and priority_rank
+
+Revision ID: 3b8e1c0f7d2a
+Revises: 1e64f390802b
+Create Date: 2026-10-18 09:12:40.118302+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8e1c0f7d2a'
+down_revision = '1e64f390802b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('task_instances', sa.Column('eligible_at', sa.DateTime))
+    op.add_column('task_instances',
+        sa.Column('priority_rank', sa.SmallInteger, nullable=False, server_default='3'))
+
+    op.execute("""
+        UPDATE task_instances SET priority_rank =
+            CASE WHEN priority = 'critical'
+                 THEN 1
+                 WHEN priority = 'high'
+                 THEN 2
+                 WHEN priority = 'low'
+                 THEN 4
+            END
+        WHERE priority != 'normal';
+        """)
+    op.execute("""
+        UPDATE task_instances SET eligible_at =
+            CASE WHEN status = 'queued'
+                 THEN run_at
+                 WHEN status = 'running'
+                 THEN locked_at + INTERVAL '1 second' * timeout
+                 WHEN status = 'retry'
+                 THEN locked_at + INTERVAL '1 second' * retry_delay
+            END
+        WHERE status IN ('queued','running','retry');
+        """)
+
+    op.alter_column('task_instances', 'priority_rank', server_default=None)
+
+    op.execute("CREATE INDEX index_task_instances_pull ON task_instances USING btree (priority_rank, eligible_at) WHERE status = ANY (ARRAY['queued'::taskflow_statuses, 'running'::taskflow_statuses, 'retry'::taskflow_statuses]);")
+
+def downgrade():
+    op.execute('DROP INDEX index_task_instances_pull;')
+    op.drop_column('task_instances', 'priority_rank')
+    op.drop_column('task_instances', 'eligible_at')
@@ -0,0 +1,25 @@
+"""add recurring instance indexes
+
+Revision ID: 5a2c9e7f1b84
+Revises: d4f7a1b93e6c
+Create Date: 2026-10-18 12:41:52.306417+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a2c9e7f1b84'
+down_revision = 'd4f7a1b93e6c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE INDEX index_workflow_instances_recurring ON workflow_instances USING btree (workflow_name, scheduled, run_at DESC);')
+    op.execute('CREATE INDEX index_task_instances_recurring ON task_instances USING btree (task_name, scheduled, run_at DESC);')
+
+def downgrade():
+    op.execute('DROP INDEX index_workflow_instances_recurring;')
+    op.execute('DROP INDEX index_task_instances_recurring;')
@@ -0,0 +1,46 @@
+"""add task instance notify triggers
+
+Revision ID: 8c51d2e4a9f0
+Revises: 3b8e1c0f7d2a
+Create Date: 2026-10-18 10:03:17.524871+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c51d2e4a9f0'
+down_revision = '3b8e1c0f7d2a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION taskflow_notify_task_instance() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('taskflow_task_instances', NEW.task_name);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER task_instances_notify_insert
+            AFTER INSERT ON task_instances
+            FOR EACH ROW
+            WHEN (NEW.status IN ('queued','retry'))
+            EXECUTE PROCEDURE taskflow_notify_task_instance();
+
+        CREATE TRIGGER task_instances_notify_update
+            AFTER UPDATE OF status ON task_instances
+            FOR EACH ROW
+            WHEN (NEW.status IN ('queued','retry') AND OLD.status IS DISTINCT FROM NEW.status)
+            EXECUTE PROCEDURE taskflow_notify_task_instance();
+        """)
+
+def downgrade():
+    op.execute("""
+        DROP TRIGGER task_instances_notify_update ON task_instances;
+        DROP TRIGGER task_instances_notify_insert ON task_instances;
+        DROP FUNCTION taskflow_notify_task_instance();
+        """)
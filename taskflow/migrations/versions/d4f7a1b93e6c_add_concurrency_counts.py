@@ -0,0 +1,107 @@
+"""add concurrency counts
+
+Revision ID: d4f7a1b93e6c
+Revises: 8c51d2e4a9f0
+Create Date: 2026-10-18 11:26:05.870144+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4f7a1b93e6c'
+down_revision = '8c51d2e4a9f0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('concurrency_counts',
+        sa.Column('definition_type', sa.String, primary_key=True),
+        sa.Column('name', sa.String, primary_key=True),
+        sa.Column('concurrency', sa.Integer),
+        sa.Column('running', sa.Integer, nullable=False)
+    )
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION taskflow_count_running_tasks() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                IF (OLD.status IN ('pushed','running')) = (NEW.status IN ('pushed','running')) THEN
+                    RETURN NULL;
+                END IF;
+            END IF;
+            IF TG_OP IN ('UPDATE','DELETE') THEN
+                IF OLD.status IN ('pushed','running') THEN
+                    UPDATE concurrency_counts SET running = GREATEST(running - 1, 0)
+                    WHERE definition_type = 'task' AND name = OLD.task_name;
+                END IF;
+            END IF;
+            IF TG_OP IN ('INSERT','UPDATE') THEN
+                IF NEW.status IN ('pushed','running') THEN
+                    INSERT INTO concurrency_counts (definition_type, name, running)
+                    VALUES ('task', NEW.task_name, 1)
+                    ON CONFLICT (definition_type, name) DO UPDATE SET running = concurrency_counts.running + 1;
+                END IF;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER task_instances_count_running
+            AFTER INSERT OR UPDATE OF status OR DELETE ON task_instances
+            FOR EACH ROW
+            EXECUTE PROCEDURE taskflow_count_running_tasks();
+
+        CREATE OR REPLACE FUNCTION taskflow_count_running_workflows() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                IF (OLD.status = 'running') = (NEW.status = 'running') THEN
+                    RETURN NULL;
+                END IF;
+            END IF;
+            IF TG_OP IN ('UPDATE','DELETE') THEN
+                IF OLD.status = 'running' THEN
+                    UPDATE concurrency_counts SET running = GREATEST(running - 1, 0)
+                    WHERE definition_type = 'workflow' AND name = OLD.workflow_name;
+                END IF;
+            END IF;
+            IF TG_OP IN ('INSERT','UPDATE') THEN
+                IF NEW.status = 'running' THEN
+                    INSERT INTO concurrency_counts (definition_type, name, running)
+                    VALUES ('workflow', NEW.workflow_name, 1)
+                    ON CONFLICT (definition_type, name) DO UPDATE SET running = concurrency_counts.running + 1;
+                END IF;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER workflow_instances_count_running
+            AFTER INSERT OR UPDATE OF status OR DELETE ON workflow_instances
+            FOR EACH ROW
+            EXECUTE PROCEDURE taskflow_count_running_workflows();
+        """)
+
+    ## limits are written by Taskflow.sync_db, backfill the running counts
+    op.execute("""
+        INSERT INTO concurrency_counts (definition_type, name, running)
+        SELECT 'task', task_name, count(*) FROM task_instances
+        WHERE status IN ('pushed','running')
+        GROUP BY task_name;
+
+        INSERT INTO concurrency_counts (definition_type, name, running)
+        SELECT 'workflow', workflow_name, count(*) FROM workflow_instances
+        WHERE status = 'running'
+        GROUP BY workflow_name;
+        """)
+
+def downgrade():
+    op.execute("""
+        DROP TRIGGER workflow_instances_count_running ON workflow_instances;
+        DROP TRIGGER task_instances_count_running ON task_instances;
+        DROP FUNCTION taskflow_count_running_workflows();
+        DROP FUNCTION taskflow_count_running_tasks();
+        """)
+    op.drop_table('concurrency_counts')
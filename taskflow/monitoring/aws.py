@@ -133,3 +133,20 @@ class AWSMonitor(MonitorDestination):
                     'Unit': 'Count'
                 }
             ])
+
+    def push_batch(self, session, push_destination, action, size):
+        self.cloudwatch.put_metric_data(
+            Namespace=self.metric_namespace,
+            MetricData=[
+                {
+                    'MetricName': self.metric_prefix + action + '_batch_size',
+                    'Dimensions': [
+                        {
+                            'Name': 'push_destination',
+                            'Value': push_destination
+                        }
+                    ],
+                    'Value': size,
+                    'Unit': 'Count'
+                }
+            ])
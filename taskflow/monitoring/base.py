@@ -32,6 +32,9 @@ class Monitor(object):
     def workflow_success(self, *args):
         self.call_destinations('workflow_success', *args)
 
+    def push_batch(self, *args):
+        self.call_destinations('push_batch', *args)
+
 
 class MonitorDestination(object):
     def heartbeat_scheduler(self, session):
@@ -51,3 +54,7 @@ class MonitorDestination(object):
 
     def workflow_success(self, session, workflow_instance):
         pass
+
+    def push_batch(self, session, push_destination, action, size):
+        """action is 'push' or 'sync', size is the number of task instances in the batch"""
+        pass
@@ -1,14 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
 import logging
+import re
 
 import boto3
 
-from .base import PushWorker
+from taskflow.core.models import TaskInstance
+from .base import PushWorker, RateLimiter, StateEventSource
+
+## most job ids a describe_jobs call accepts
+describe_jobs_limit = 100
+
+job_statuses = {
+    'SUBMITTED': 'pushed',
+    'PENDING': 'pushed',
+    'RUNNABLE': 'pushed',
+    'STARTING': 'running',
+    'RUNNING': 'running',
+    'SUCCEEDED': 'success',
+    'FAILED': 'failed'
+}
+
+## order of job statuses, a job only moves forward
+job_status_order = ['SUBMITTED', 'PENDING', 'RUNNABLE', 'STARTING', 'RUNNING', 'SUCCEEDED', 'FAILED']
+
+## most messages an SQS receive_message or delete_message_batch call accepts
+sqs_batch_limit = 10
+
+class SQSJobEventSource(StateEventSource):
+    """Receives AWS Batch "Batch Job State Change" events from an SQS queue, delivered by an
+       EventBridge rule matching {"source": ["aws.batch"], "detail-type": ["Batch Job State Change"]}.
+       The event's detail is the job, as returned by describe_jobs."""
+
+    def __init__(self, queue_url, wait_time=0):
+        self.logger = logging.getLogger('SQSJobEventSource')
+
+        self.sqs_client = boto3.client('sqs')
+        self.queue_url = queue_url
+        self.wait_time = wait_time
+
+    def receive(self):
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=sqs_batch_limit,
+            WaitTimeSeconds=self.wait_time)
+
+        events = []
+        for message in response.get('Messages', []):
+            try:
+                body = json.loads(message['Body'])
+            except ValueError:
+                body = None
+
+            if isinstance(body, dict) and body.get('detail-type') == 'Batch Job State Change':
+                events.append((body['detail'], message['ReceiptHandle']))
+            else:
+                self.logger.warning('Ignoring message %s, not a Batch Job State Change', message['MessageId'])
+                events.append((None, message['ReceiptHandle']))
+        return events
+
+    def ack(self, receipts):
+        for i in range(0, len(receipts), sqs_batch_limit):
+            self.sqs_client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(n), 'ReceiptHandle': receipt}
+                         for n, receipt in enumerate(receipts[i:i + sqs_batch_limit])])
 
 class AWSBatchPushWorker(PushWorker):
     supports_state_sync = True
     push_type = 'aws_batch'
 
-    def __init__(self, *args, default_job_queue=None, default_job_definition=None, **kwargs):
+    def __init__(self,
+                 *args,
+                 default_job_queue=None,
+                 default_job_definition=None,
+                 api_threads=10,
+                 submit_rate=20,
+                 submit_burst=None,
+                 queue_timeout=None,
+                 **kwargs):
         self.logger = logging.getLogger('AWSBatchPushWorker')
 
         super(AWSBatchPushWorker, self).__init__(*args, **kwargs)
@@ -17,6 +88,19 @@ class AWSBatchPushWorker(PushWorker):
         self.default_job_queue = default_job_queue
         self.default_job_definition = default_job_definition
 
+        ## AWS Batch API calls are made concurrently on the API pool. Jobs are submitted at
+        ## most submit_rate per second, see the SubmitJob quota of the AWS Batch API
+        self.api_pool = ThreadPoolExecutor(max_workers=api_threads)
+        self.submit_limiter = RateLimiter(submit_rate, burst=submit_burst)
+
+        ## seconds a pushed job may wait in its job queue before it is terminated and failed,
+        ## None waits indefinitely. Running jobs are bound by their task instance's timeout
+        self.queue_timeout = queue_timeout
+
+    def close(self):
+        ## waits for in flight API calls
+        self.api_pool.shutdown(wait=True)
+
     def get_log_url(self, task_instance):
         try:
             push_state = task_instance.push_state
@@ -29,38 +113,162 @@ class AWSBatchPushWorker(PushWorker):
 
         return None
 
+    def describe_jobs(self, job_ids):
+        """Runs on the API pool"""
+        return self.batch_client.describe_jobs(jobs=job_ids)['jobs']
+
     def sync_task_instance_states(self, session, dry_run, task_instances, now):
+        """Describes the jobs of pushed task instances, in chunks of up to 100 jobs on the API pool.
+           Jobs moving between pushed and running are written in one bulk update. Finished jobs
+           complete their task instances through succeed and fail. Jobs missing from AWS Batch,
+           and jobs that time out, see is_timed_out, are failed, and the late jobs are
+           terminated."""
         jobs = dict()
         for task_instance in task_instances:
-            jobs[task_instance.push_state['jobId']] = task_instance
-
-        response = self.batch_client.describe_jobs(jobs=list(jobs.keys())) ## TODO: batch by 100
-
-        ## TODO: tasks that go past 24 hour period ?
-        ## TODO: timeout pushed tasks?
-        ## TODO: tasks that are 'pushed' but not in AWS batch?
-
-        for job in response['jobs']:
-            if job['status'] in ['SUBMITTED','PENDING','RUNNABLE']:
-                status = 'pushed'
-            elif job['status'] in ['STARTING','RUNNING']:
-                status = 'running'
-            elif job['status'] == 'SUCCEEDED':
-                status = 'success'
-            elif job['status'] == 'FAILED':
-                status = 'failed'
-
-            task_instance = jobs[job['jobId']]
-            if task_instance.status != status:
-                task_instance.push_state = job
-
-                if status == 'failed':
-                    task_instance.fail(session, self.taskflow, now=now, dry_run=dry_run)
+            ## claimed by the Pusher, but not yet submitted
+            if task_instance.push_state and 'jobId' in task_instance.push_state:
+                jobs[task_instance.push_state['jobId']] = task_instance
+
+        job_ids = list(jobs.keys())
+        chunks = [job_ids[i:i + describe_jobs_limit] for i in range(0, len(job_ids), describe_jobs_limit)]
+
+        described = dict()
+        for chunk_jobs in self.api_pool.map(self.describe_jobs, chunks):
+            for job in chunk_jobs:
+                described[job['jobId']] = job
+
+        self.update_task_instance_states(session, dry_run, jobs, described, now)
+
+    def is_timed_out(self, task_instance, job, status, now):
+        """Running jobs time out once their task instance's timeout has passed since the job started.
+           Jobs still waiting in their job queue time out queue_timeout seconds after being pulled
+           by the Pusher."""
+        if status == 'running':
+            ## epoch milliseconds, not set until the container starts
+            started_at = job.get('startedAt')
+            return started_at != None and \
+                   now >= datetime.utcfromtimestamp(started_at / 1000.0) + timedelta(seconds=task_instance.timeout)
+        if status == 'pushed':
+            return self.queue_timeout != None and \
+                   task_instance.locked_at != None and \
+                   now >= task_instance.locked_at + timedelta(seconds=self.queue_timeout)
+        return False
+
+    def update_task_instance_states(self, session, dry_run, jobs, described, now):
+        """Applies the described jobs to their task instances, jobs is a dict of job id -> task
+           instance and described a dict of job id -> job"""
+        mappings = []
+        completed = [] ## (task_instance, status, push_state)
+        for job_id, task_instance in jobs.items():
+            job = described.get(job_id)
+
+            if job == None:
+                self.logger.warning('Job %s of task instance %s not found in AWS Batch', job_id, task_instance.id)
+                push_state = dict(task_instance.push_state)
+                push_state['missing'] = True
+                completed.append((task_instance, 'failed', push_state))
+                continue
+
+            status = job_statuses[job['status']]
+
+            timed_out = self.is_timed_out(task_instance, job, status, now)
+            if timed_out:
+                self.logger.warning('Job %s of task instance %s timed out', job_id, task_instance.id)
+                if not dry_run:
+                    try:
+                        self.batch_client.terminate_job(jobId=job_id, reason='Timed out in Taskflow')
+                    except Exception:
+                        ## retried on the next sync
+                        self.logger.exception('Exception terminating job %s', job_id)
+                        timed_out = False
+
+            if timed_out:
+                completed.append((task_instance, 'failed', job))
+            elif status in ['success', 'failed']:
+                completed.append((task_instance, status, job))
+            elif status != task_instance.status:
+                mappings.append({
+                    'id': task_instance.id,
+                    'status': status,
+                    'push_state': job
+                })
+
+        if dry_run:
+            for task_instance, status, push_state in completed:
+                self.logger.info('Completing task instance %s as %s', task_instance.id, status)
+            return
+
+        if len(mappings) > 0:
+            session.bulk_update_mappings(TaskInstance, mappings)
+        session.commit()
+
+        for task_instance, status, push_state in completed:
+            try:
+                task_instance.push_state = push_state
+                if status == 'success':
+                    task_instance.succeed(session, self.taskflow, now=now)
                 else:
-                    task_instance.status = status
+                    task_instance.fail(session, self.taskflow, now=now)
+            except Exception:
+                self.logger.exception('Exception completing task instance %s', task_instance.id)
+                session.rollback()
+
+    def get_task_instance_id(self, job_name):
+        """Parses the task instance id from the end of a job name, see get_job_name"""
+        try:
+            return int(job_name.rsplit('__', 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+    def consume_state_events(self, session, dry_run, now, max_events=1000):
+        """Applies job state change events from the event source, a received batch at a time, and
+           acks them once applied. Events of jobs not submitted by this Taskflow are dropped."""
+        count = 0
+        while count < max_events:
+            events = self.event_source.receive()
+            if len(events) == 0:
+                break
+            count += len(events)
+
+            ## the furthest along event of each task instance's job, a job only moves forward
+            latest = dict()
+            for job, receipt in events:
+                if job == None or job.get('status') not in job_statuses:
+                    continue
+                task_instance_id = self.get_task_instance_id(job.get('jobName', ''))
+                if task_instance_id == None:
+                    continue
+                current = latest.get(task_instance_id)
+                if current == None or \
+                   job_status_order.index(job['status']) > job_status_order.index(current['status']):
+                    latest[task_instance_id] = job
+
+            jobs = dict()
+            if len(latest) > 0:
+                task_instances = session.query(TaskInstance)\
+                    .filter(TaskInstance.id.in_(list(latest.keys())),
+                            TaskInstance.push == True,
+                            TaskInstance.status.in_(['pushed','running']))\
+                    .all()
+                for task_instance in task_instances:
+                    job = latest[task_instance.id]
+                    push_state = task_instance.push_state
+                    if not push_state or push_state.get('jobId') != job['jobId']:
+                        continue
+                    ## stale events, delivered after a later state was applied
+                    if push_state.get('status') in job_status_order and \
+                       job_status_order.index(job['status']) < job_status_order.index(push_state['status']):
+                        continue
+                    jobs[job['jobId']] = task_instance
+
+            described = dict((job['jobId'], job) for job in latest.values())
+            self.update_task_instance_states(session, dry_run, jobs, described, now)
+
+            if dry_run:
+                break
+            self.event_source.ack([receipt for job, receipt in events])
 
-        if not dry_run:
-            session.commit()
+        return count
 
     def get_job_name(self, workflow, task, task_instance):
         if workflow != None:
@@ -74,82 +282,111 @@ class AWSBatchPushWorker(PushWorker):
                 task.name,
                 task_instance.id)
 
-    def push_task_instances(self, session, dry_run, task_instances):
-        for task_instance in task_instances:
-            try:
-                task = self.taskflow.get_task(task_instance.task_name)
-                workflow = None
+    def get_job(self, task_instance):
+        """Returns the submit_job arguments for a task instance"""
+        task = self.taskflow.get_task(task_instance.task_name)
+        if task == None:
+            raise Exception('Task `{}` not found'.format(task_instance.task_name))
 
-                if task.workflow != None:
-                    workflow = self.taskflow.get_workflow(task.workflow.name)
+        workflow = None
+        if task.workflow != None:
+            workflow = self.taskflow.get_workflow(task.workflow.name)
 
-                if task == None:
-                    raise Exception('Task `{}` not found'.format(task_instance.task_name))
+        parameters = {
+            'task': task.name,
+            'task_instance': str(task_instance.id)
+        }
 
-                parameters = {
-                    'task': task.name,
-                    'task_instance': str(task_instance.id)
-                }
+        if workflow != None:
+            parameters['workflow'] = workflow.name
+            parameters['workflow_instance'] = str(task_instance.workflow_instance_id)
 
-                if workflow != None:
-                    parameters['workflow'] = workflow.name
-                    parameters['workflow_instance'] = str(task_instance.workflow_instance_id)
+        if 'job_queue' in task_instance.params and task_instance.params['job_queue']:
+            job_queue = task_instance.params['job_queue']
+        elif 'job_queue' in task.params and task.params['job_queue']:
+            job_queue = task.params['job_queue']
+        else:
+            job_queue = self.default_job_queue
 
-                if 'job_queue' in task_instance.params and task_instance.params['job_queue']:
-                    job_queue = task_instance.params['job_queue']
-                elif 'job_queue' in task.params and task.params['job_queue']:
-                    job_queue = task.params['job_queue']
-                else:
-                    job_queue = self.default_job_queue
+        if 'job_definition' in task_instance.params and task_instance.params['job_definition']:
+            job_definition = task_instance.params['job_definition']
+        elif 'job_definition' in task.params and task.params['job_definition']:
+            job_definition = task.params['job_definition']
+        else:
+            job_definition = self.default_job_definition
 
-                if 'job_definition' in task_instance.params and task_instance.params['job_definition']:
-                    job_definition = task_instance.params['job_definition']
-                elif 'job_definition' in task.params and task.params['job_definition']:
-                    job_definition = task.params['job_definition']
-                else:
-                    job_definition = self.default_job_definition
-
-                environment = [
-                    {
-                        'name': 'TASKFLOW_TASK',
-                        'value': task.name
-                    },
-                    {
-                        'name': 'TASKFLOW_TASK_INSTANCE_ID',
-                        'value': str(task_instance.id)
-                    }
-                ]
-
-                if workflow != None:
-                    environment.append({
-                        'name': 'TASKFLOW_WORKFLOW',
-                        'value': workflow.name
-                    })
-                    environment.append({
-                        'name': 'TASKFLOW_WORKFLOW_INSTANCE_ID',
-                        'value': str(task_instance.workflow_instance_id)
-                    })
-
-                job_name = self.get_job_name(workflow, task, task_instance)
-                job_name = job_name[-128:] ## AWS Batch max job name is 128 characters
-
-                self.logger.info('Submitting job: %s %s %s', job_name, job_queue, job_definition)
+        environment = [
+            {
+                'name': 'TASKFLOW_TASK',
+                'value': task.name
+            },
+            {
+                'name': 'TASKFLOW_TASK_INSTANCE_ID',
+                'value': str(task_instance.id)
+            }
+        ]
 
-                if not dry_run:
-                    response = self.batch_client.submit_job(
-                        jobName=job_name,
-                        jobQueue=job_queue,
-                        jobDefinition=job_definition,
-                        parameters=parameters,
-                        containerOverrides={
-                            'environment': environment
-                        })
-
-                task_instance.state = 'pushed'
-                task_instance.push_state = response
+        if workflow != None:
+            environment.append({
+                'name': 'TASKFLOW_WORKFLOW',
+                'value': workflow.name
+            })
+            environment.append({
+                'name': 'TASKFLOW_WORKFLOW_INSTANCE_ID',
+                'value': str(task_instance.workflow_instance_id)
+            })
 
-                if not dry_run:
-                    session.commit()
+        job_name = self.get_job_name(workflow, task, task_instance)
+        job_name = job_name[-128:] ## AWS Batch max job name is 128 characters
+
+        return {
+            'jobName': job_name,
+            'jobQueue': job_queue,
+            'jobDefinition': job_definition,
+            'parameters': parameters,
+            'containerOverrides': {
+                'environment': environment
+            }
+        }
+
+    def submit_job(self, task_instance_id, job):
+        """Runs on the API pool, returns (task_instance_id, response), response is None on failure"""
+        try:
+            self.submit_limiter.acquire()
+            self.logger.info('Submitting job: %s %s %s', job['jobName'], job['jobQueue'], job['jobDefinition'])
+            return task_instance_id, self.batch_client.submit_job(**job)
+        except Exception:
+            self.logger.exception('Exception submitting %s', job['jobName'])
+            return task_instance_id, None
+
+    def push_task_instances(self, session, dry_run, task_instances):
+        """Submits jobs concurrently on the API pool, within the submit rate limit, then marks the
+           submitted task instances as pushed in one bulk update. Task instances that fail to submit
+           stay claimed by the Pusher, and are pulled again once their timeout passes."""
+        jobs = []
+        for task_instance in task_instances:
+            try:
+                jobs.append((task_instance.id, self.get_job(task_instance)))
             except Exception:
                 self.logger.exception('Exception submitting %s %s', task_instance.task_name, task_instance.id)
-                session.rollback()
+
+        if dry_run:
+            for task_instance_id, job in jobs:
+                self.logger.info('Submitting job: %s %s %s', job['jobName'], job['jobQueue'], job['jobDefinition'])
+            return
+
+        results = self.api_pool.map(lambda args: self.submit_job(*args), jobs)
+
+        mappings = []
+        for task_instance_id, response in results:
+            if response != None:
+                mappings.append({
+                    'id': task_instance_id,
+                    'status': 'pushed',
+                    'push_state': response,
+                    'eligible_at': None
+                })
+
+        if len(mappings) > 0:
+            session.bulk_update_mappings(TaskInstance, mappings)
+        session.commit()
@@ -1,11 +1,84 @@
+from collections import deque
+import threading
+import time
+
+class RateLimiter(object):
+    """Thread safe token bucket, allows `rate` calls per second on average
+       with bursts of up to `burst` calls"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call is allowed"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class StateEventSource(object):
+    """A queue of job state change events from a push destination. receive returns a list of
+       (event, receipt), event is None for messages that are not state changes. Events are
+       delivered until their receipts are acked."""
+
+    def receive(self):
+        raise NotImplementedError()
+
+    def ack(self, receipts):
+        raise NotImplementedError()
+
+class FakeStateEventSource(StateEventSource):
+    """In process event source for tests, events are received once, in the order they are put"""
+
+    def __init__(self, batch_size=10):
+        self.batch_size = batch_size
+        self.events = deque()
+        self.received = 0
+        self.acked = []
+
+    def put(self, event):
+        self.events.append(event)
+
+    def receive(self):
+        events = []
+        while len(self.events) > 0 and len(events) < self.batch_size:
+            events.append((self.events.popleft(), self.received))
+            self.received += 1
+        return events
+
+    def ack(self, receipts):
+        self.acked.extend(receipts)
 
 class PushWorker(object):
     supports_state_sync = False
     push_type = None
 
-    def __init__(self, taskflow):
+    def __init__(self, taskflow, event_source=None):
         self.taskflow = taskflow
 
+        ## optional StateEventSource, state changes are applied as they arrive and
+        ## sync_task_instance_states becomes a slower reconciliation sweep
+        self.event_source = event_source
+
+    def close(self):
+        """Releases the push worker's resources, such as threads and connections"""
+        pass
+
+    def consume_state_events(self, session, dry_run, now):
+        """Applies the state change events waiting on the event source, returns the number of events"""
+        raise NotImplementedError()
+
     def sync_task_instance_states(self, session, task_instances):
         raise NotImplementedError()
 
@@ -9,7 +9,7 @@ from flask_login import LoginManager
 from taskflow.rest import resources
 from taskflow.core.models import metadata, BaseModel, User
 
-def create_app(taskflow_instance, connection_string=None, secret_key=None):
+def create_app(taskflow_instance, connection_string=None, secret_key=None, definitions_ttl=5):
     app = flask.Flask(__name__)
     app.config['DEBUG'] = os.getenv('DEBUG', False)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -39,7 +39,8 @@ def create_app(taskflow_instance, connection_string=None, secret_key=None):
 
     attrs = {
         'session': db.session,
-        'taskflow': taskflow_instance
+        'taskflow': taskflow_instance,
+        'definition_cache': resources.DefinitionCache(taskflow_instance, ttl=definitions_ttl)
     }
 
     with app.app_context():
@@ -1,4 +1,6 @@
 from datetime import datetime
+import threading
+import time
 
 from marshmallow import Schema, fields
 from marshmallow_sqlalchemy import ModelSchema, field_for
@@ -40,6 +42,27 @@ def to_list_response(data):
         'page': 1 if count > 0 else 0,
     }
 
+class DefinitionCache(object):
+    """Per process cache of the definitions' `active` flags. The flags are refreshed from the
+       database by Taskflow.sync_db at most once every ttl seconds, or on the next request
+       after invalidate()"""
+    def __init__(self, taskflow, ttl=5):
+        self.taskflow = taskflow
+        self.ttl = ttl
+        self.synced_at = None
+        self.lock = threading.Lock()
+
+    def refresh(self, session):
+        with self.lock:
+            now = time.monotonic()
+            if self.synced_at == None or now - self.synced_at >= self.ttl:
+                self.taskflow.sync_db(session, read_only=True)
+                self.synced_at = now
+
+    def invalidate(self):
+        with self.lock:
+            self.synced_at = None
+
 class SchedulableSchema(Schema):
     name = fields.String(dump_only=True)
     active = fields.Boolean(required=True)
@@ -48,6 +71,7 @@ class SchedulableSchema(Schema):
     concurrency = fields.Integer(dump_only=True)
     sla = fields.Integer(dump_only=True)
     schedule = fields.String(dump_only=True)
+    jitter = fields.Integer(dump_only=True)
     default_priority = fields.String(dump_only=True)
     start_date = fields.DateTime(dump_only=True)
     end_date = fields.DateTime(dump_only=True)
@@ -65,7 +89,7 @@ class WorkflowListResource(Resource):
     method_decorators = [csrf.csrf_check, standard_authorization, login_required]
 
     def get(self):
-        self.taskflow.sync_db(self.session, read_only=True)
+        self.definition_cache.refresh(self.session)
         workflows = sorted(self.taskflow.get_workflows(), key=lambda workflow: workflow.name)
         workflows_data = workflows_schema.dump(workflows).data
         return to_list_response(workflows_data)
@@ -74,7 +98,7 @@ class WorkflowResource(Resource):
     method_decorators = [csrf.csrf_check, standard_authorization, login_required]
 
     def get(self, workflow_name):
-        self.taskflow.sync_db(self.session, read_only=True)
+        self.definition_cache.refresh(self.session)
         workflow = self.taskflow.get_workflow(workflow_name)
         return workflow_schema.dump(workflow).data
 
@@ -84,14 +108,19 @@ class WorkflowResource(Resource):
         if input_workflow.errors:
             abort(400, errors=input_workflow.errors)
 
-        self.taskflow.sync_db(self.session, read_only=True)
+        self.definition_cache.refresh(self.session)
         workflow = self.taskflow.get_workflow(workflow_name)
 
         if not workflow:
             abort(404)
 
+        ## definitions are not attached to the session, update the row directly
+        self.session.query(Workflow)\
+            .filter(Workflow.name == workflow_name)\
+            .update({'active': input_workflow.data['active']}, synchronize_session=False)
         workflow.active = input_workflow.data['active']
         self.session.commit()
+        self.definition_cache.invalidate()
 
         return workflow_schema.dump(workflow).data
 
@@ -102,7 +131,7 @@ class TaskListResource(Resource):
     method_decorators = [csrf.csrf_check, standard_authorization, login_required]
 
     def get(self):
-        self.taskflow.sync_db(self.session, read_only=True)
+        self.definition_cache.refresh(self.session)
         tasks = list(self.taskflow.get_tasks())
         for workflow in self.taskflow.get_workflows():
             tasks += workflow.get_tasks()
@@ -114,7 +143,7 @@ class TaskResource(Resource):
     method_decorators = [csrf.csrf_check, standard_authorization, login_required]
 
     def get(self, task_name):
-        self.taskflow.sync_db(self.session, read_only=True)
+        self.definition_cache.refresh(self.session)
         task = self.taskflow.get_task(task_name)
         return task_schema.dump(task).data
 
@@ -124,14 +153,19 @@ class TaskResource(Resource):
         if input_task.errors:
             abort(400, errors=input_task.errors)
 
-        self.taskflow.sync_db(self.session, read_only=True)
+        self.definition_cache.refresh(self.session)
         task = self.taskflow.get_task(task_name)
 
         if not task:
             abort(404)
 
+        ## definitions are not attached to the session, update the row directly
+        self.session.query(Task)\
+            .filter(Task.name == task_name)\
+            .update({'active': input_task.data['active']}, synchronize_session=False)
         task.active = input_task.data['active']
         self.session.commit()
+        self.definition_cache.invalidate()
 
         return task_schema.dump(task).data
 
@@ -202,6 +236,8 @@ class TaskInstanceSchema(ModelSchema):
     workflow_instance_id = field_for(TaskInstance, 'workflow_instance_id', dump_only=True)
     status = field_for(TaskInstance, 'status', dump_only=True)
     scheduled = field_for(WorkflowInstance, 'scheduled', dump_only=True)
+    eligible_at = field_for(TaskInstance, 'eligible_at', dump_only=True)
+    priority_rank = field_for(TaskInstance, 'priority_rank', dump_only=True)
     created_at = field_for(TaskInstance, 'created_at', dump_only=True)
     updated_at = field_for(TaskInstance, 'updated_at', dump_only=True)
 
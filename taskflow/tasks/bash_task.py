@@ -7,7 +7,7 @@ import shutil
 import time
 from subprocess import Popen, PIPE
 from tempfile import gettempdir, NamedTemporaryFile
-from threading import Thread
+from threading import Thread, Lock
 from contextlib import contextmanager
 from tempfile import mkdtemp
 
@@ -51,6 +51,13 @@ def replace_environment_variables(input_str):
     return out_str
 
 class BashTask(Task):
+    def __init__(self, *args, **kwargs):
+        super(BashTask, self).__init__(*args, **kwargs)
+
+        ## task instance id -> bash subprocess, instances of a task can run concurrently
+        self.processes = dict()
+        self.processes_lock = Lock()
+
     def get_command(self):
         return self.params['command']
 
@@ -101,7 +108,8 @@ class BashTask(Task):
                     bufsize=1,
                     close_fds=ON_POSIX)
 
-                self.sp = sp
+                with self.processes_lock:
+                    self.processes[task_instance.id] = sp
 
                 input_thread = None
                 if input_file:
@@ -111,10 +119,14 @@ class BashTask(Task):
                 if output_file:
                     output_thread = pipe_stream(sp.stdout, output_file)
 
-                for line in iter(sp.stderr.readline, b''):
-                    logger.info(line)
+                try:
+                    for line in iter(sp.stderr.readline, b''):
+                        logger.info(line)
 
-                sp.wait()
+                    sp.wait()
+                finally:
+                    with self.processes_lock:
+                        self.processes.pop(task_instance.id, None)
 
                 if input_thread:
                     input_thread.join(timeout=5)
@@ -136,6 +148,19 @@ class BashTask(Task):
                 if sp.returncode:
                     raise Exception('Bash command failed')
 
-    def on_kill(self):
-        logging.info('Sending SIGTERM signal to bash process group')
-        os.killpg(os.getpgid(self.sp.pid), signal.SIGTERM)
+    def on_kill(self, task_instance_id=None):
+        """Terminates the bash process group of a task instance, or of every running instance"""
+        with self.processes_lock:
+            if task_instance_id == None:
+                processes = list(self.processes.values())
+            elif task_instance_id in self.processes:
+                processes = [self.processes[task_instance_id]]
+            else:
+                processes = []
+
+        for sp in processes:
+            logging.info('Sending SIGTERM signal to bash process group %s', sp.pid)
+            try:
+                os.killpg(os.getpgid(sp.pid), signal.SIGTERM)
+            except ProcessLookupError:
+                pass ## already exited
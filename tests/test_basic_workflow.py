@@ -1,9 +1,14 @@
 from datetime import datetime
+import gc
 
 import pytest
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from toposort import CircularDependencyError
 
 from taskflow import Scheduler, Taskflow, Workflow, WorkflowInstance, Task, TaskInstance
+from taskflow.core.models import ConcurrencyCount
+from taskflow.core.scheduler import LeaderLock
 from shared_fixtures import *
 
 get_logging()
@@ -348,3 +353,320 @@ def test_workflow_fail(dbsession, workflows):
             assert instance.status == 'success'
         elif instance.task_name == 'task3':
             assert instance.status == 'failed'
+
+def test_advance_workflows_paginated(dbsession, workflows):
+    taskflow = Taskflow()
+    taskflow.add_workflows(workflows)
+
+    workflow_instance_ids = []
+    for hour in [6, 7, 8]:
+        workflow_instance = WorkflowInstance(
+            workflow_name='workflow1',
+            scheduled=False,
+            run_at=datetime(2017, 6, 3, hour),
+            started_at=datetime(2017, 6, 3, hour),
+            status='running',
+            priority='normal')
+        dbsession.add(workflow_instance)
+        dbsession.commit()
+        workflow_instance_ids.append(workflow_instance.id)
+
+    scheduler = Scheduler(taskflow, now_override=datetime(2017, 6, 3, 9), page_size=2)
+    scheduler.advance_workflows_forward(dbsession)
+
+    task_instances = dbsession.query(TaskInstance).all()
+    assert len(task_instances) == 6
+    for workflow_instance_id in workflow_instance_ids:
+        workflow_task_instances = list(filter(
+            lambda instance: instance.workflow_instance_id == workflow_instance_id,
+            task_instances))
+        assert set(instance.task_name for instance in workflow_task_instances) == set(['task1','task2'])
+
+def test_task_success_advances_workflow(dbsession, workflows):
+    taskflow = Taskflow()
+    taskflow.add_workflows(workflows)
+
+    workflow_instance = WorkflowInstance(
+        workflow_name='workflow1',
+        scheduled=True,
+        run_at=datetime(2017, 6, 3, 6),
+        status='running',
+        priority='normal')
+    dbsession.add(workflow_instance)
+    dbsession.commit()
+    task_instance1 = TaskInstance(
+        task_name='task1',
+        scheduled=True,
+        workflow_instance_id=workflow_instance.id,
+        status='success',
+        run_at=datetime(2017, 6, 3, 6, 0, 34),
+        attempts=1,
+        priority='normal',
+        push=False,
+        timeout=300,
+        retry_delay=300)
+    task_instance2 = TaskInstance(
+        task_name='task2',
+        scheduled=True,
+        workflow_instance_id=workflow_instance.id,
+        status='running',
+        run_at=datetime(2017, 6, 3, 6, 0, 34),
+        attempts=1,
+        priority='normal',
+        push=False,
+        timeout=300,
+        retry_delay=300)
+    dbsession.add(task_instance1)
+    dbsession.add(task_instance2)
+    dbsession.commit()
+
+    now = datetime(2017, 6, 3, 6, 1)
+    task_instance2.succeed(dbsession, taskflow, now=now)
+
+    ## queued without a scheduler run
+    task3_instance = dbsession.query(TaskInstance).filter(TaskInstance.task_name == 'task3').one()
+    assert task3_instance.status == 'queued'
+    assert task3_instance.run_at == now
+    assert task3_instance.workflow_instance_id == workflow_instance.id
+
+def test_workflow_per_task_readiness(dbsession):
+    workflow = Workflow(name='uneven_workflow', active=True)
+    task_a = Task(workflow=workflow, name='task_a', active=True)
+    task_b = Task(workflow=workflow, name='task_b', active=True)
+    task_c = Task(workflow=workflow, name='task_c', active=True)
+    task_d = Task(workflow=workflow, name='task_d', active=True)
+    task_c.depends_on(task_a)
+    task_d.depends_on(task_b)
+
+    taskflow = Taskflow()
+    taskflow.add_workflow(workflow)
+
+    workflow_instance = WorkflowInstance(
+        workflow_name='uneven_workflow',
+        scheduled=True,
+        run_at=datetime(2017, 6, 3, 6),
+        status='running',
+        priority='normal')
+    dbsession.add(workflow_instance)
+    dbsession.commit()
+    dbsession.add(task_a.get_new_instance(workflow_instance_id=workflow_instance.id, status='success'))
+    dbsession.add(task_b.get_new_instance(workflow_instance_id=workflow_instance.id, status='running'))
+    dbsession.commit()
+
+    scheduler = Scheduler(taskflow, now_override=datetime(2017, 6, 3, 6, 12))
+    scheduler.advance_workflows_forward(dbsession)
+
+    ## task_c does not wait on the slow task_b branch
+    task_instances = dbsession.query(TaskInstance).all()
+    assert len(task_instances) == 3
+    assert set(instance.task_name for instance in task_instances) == set(['task_a','task_b','task_c'])
+
+def test_workflow_graph():
+    workflow = Workflow(name='workflow1')
+    task1 = Task(workflow=workflow, name='task1')
+    task2 = Task(workflow=workflow, name='task2')
+    task3 = Task(workflow=workflow, name='task3')
+    task3.depends_on(task1)
+    task3.depends_on(task2)
+
+    graph = workflow.get_graph()
+    assert graph.order == ('task1', 'task2', 'task3')
+    assert graph.roots == frozenset(['task1', 'task2'])
+    assert graph.dependents['task1'] == frozenset(['task3'])
+    assert graph.indegrees['task3'] == 2
+    assert workflow.get_graph() is graph
+
+    ## changing dependencies recompiles
+    task4 = Task(workflow=workflow, name='task4')
+    task4.depends_on(task3)
+    assert workflow.get_graph().order == ('task1', 'task2', 'task3', 'task4')
+
+    task1.depends_on(task4)
+    with pytest.raises(CircularDependencyError):
+        Taskflow().add_workflow(workflow)
+
+def test_definition_lookup_index():
+    taskflow = Taskflow()
+
+    workflow1 = Workflow(name='workflow1')
+    task1 = Task(workflow=workflow1, name='task1')
+    taskflow.add_workflow(workflow1)
+
+    standalone = Task(name='standalone')
+    taskflow.add_task(standalone)
+
+    assert taskflow.get_workflow('workflow1') == workflow1
+    assert taskflow.get_workflow('missing') == None
+    assert taskflow.get_task('task1') == task1
+    assert taskflow.get_task('standalone') == standalone
+    assert workflow1.get_task('task1') == task1
+
+    ## tasks added after the workflow are indexed too
+    task2 = Task(workflow=workflow1, name='task2')
+    assert taskflow.get_task('task2') == task2
+
+    ## task names are unique across workflows
+    workflow2 = Workflow(name='workflow2')
+    Task(workflow=workflow2, name='workflow2_task')
+    Task(workflow=workflow2, name='task1')
+    with pytest.raises(Exception):
+        taskflow.add_workflow(workflow2)
+    ## none of the rejected workflow's tasks are left in the index
+    assert taskflow.get_task('workflow2_task') == None
+    assert taskflow.get_task('task1') == task1
+    assert taskflow.get_workflow('workflow2') == None
+
+    with pytest.raises(Exception):
+        Task(workflow=workflow1, name='standalone')
+
+    with pytest.raises(Exception):
+        Task(workflow=workflow1, name='task2')
+
+def test_sync_db(dbsession):
+    workflow = Workflow(name='sync_workflow', active=True, concurrency=2)
+    task1 = Task(workflow=workflow, name='sync_task1', active=True)
+    task2 = Task(name='sync_task2', active=False, concurrency=None)
+
+    taskflow = Taskflow()
+    taskflow.add_workflow(workflow)
+    taskflow.add_task(task2)
+    taskflow.sync_db(dbsession)
+
+    rows = dict((task.name, task) for task in dbsession.query(Task).all())
+    assert rows['sync_task1'].workflow_name == 'sync_workflow'
+    assert rows['sync_task1'].active == True
+    assert rows['sync_task2'].active == False
+    assert dbsession.query(ConcurrencyCount).get(('workflow', 'sync_workflow')).concurrency == 2
+    assert dbsession.query(ConcurrencyCount).get(('task', 'sync_task2')).concurrency == None
+
+    ## active is owned by the database
+    dbsession.execute("UPDATE tasks SET active = false WHERE name = 'sync_task1'")
+    dbsession.commit()
+    taskflow.sync_db(dbsession, read_only=True)
+    assert task1.active == False
+
+    ## changed limits are written, active is not
+    workflow.concurrency = 3
+    taskflow.sync_db(dbsession)
+    assert dbsession.query(ConcurrencyCount).get(('workflow', 'sync_workflow')).concurrency == 3
+    assert dbsession.query(Task).get('sync_task1').active == False
+
+def test_leader_lock(engine):
+    leader = LeaderLock(engine)
+    standby = LeaderLock(engine)
+
+    assert leader.acquire() == True
+    ## the pooled connections of the engine are free, the lock's connection is not among them
+    gc.collect()
+    session = sessionmaker(bind=engine)()
+    session.execute('SELECT 1;')
+    session.close()
+
+    for n in range(3):
+        assert standby.acquire() == False
+        ## the leader keeps the lock across cycles
+        assert leader.acquire() == True
+
+    leader.release()
+    assert standby.acquire() == True
+    assert leader.acquire() == False
+    standby.release()
+
+def test_advance_workflows_parallel(dbsession, engine, workflows):
+    taskflow = Taskflow()
+    taskflow.add_workflows(workflows)
+
+    workflow_instance_ids = []
+    for hour in [6, 7, 8, 9]:
+        workflow_instance = WorkflowInstance(
+            workflow_name='workflow1',
+            scheduled=False,
+            run_at=datetime(2017, 6, 3, hour),
+            started_at=datetime(2017, 6, 3, hour),
+            status='running',
+            priority='normal')
+        dbsession.add(workflow_instance)
+        dbsession.commit()
+        workflow_instance_ids.append(workflow_instance.id)
+
+    ## claimed by another advancer, skipped
+    other_session = sessionmaker(bind=engine)()
+    other_session.query(WorkflowInstance)\
+        .filter(WorkflowInstance.id == workflow_instance_ids[0])\
+        .with_for_update()\
+        .one()
+
+    scheduler = Scheduler(taskflow,
+                          now_override=datetime(2017, 6, 3, 10),
+                          advance_threads=2,
+                          session_factory=sessionmaker(bind=engine))
+    scheduler.advance_workflows_parallel()
+    other_session.rollback()
+    other_session.close()
+
+    task_instances = dbsession.query(TaskInstance).all()
+    assert len(task_instances) == 6
+    assert set(instance.workflow_instance_id for instance in task_instances) == set(workflow_instance_ids[1:])
+
+def test_workflow_lookahead(dbsession, workflows):
+    taskflow = Taskflow()
+    taskflow.add_workflows(workflows)
+
+    run_at = datetime(2017, 6, 3, 6)
+    workflow_instance = WorkflowInstance(
+        workflow_name='workflow1',
+        scheduled=True,
+        run_at=run_at,
+        status='queued',
+        priority='normal')
+    dbsession.add(workflow_instance)
+    dbsession.commit()
+
+    ## outside of the lookahead, not started
+    scheduler = Scheduler(taskflow, now_override=datetime(2017, 6, 3, 5, 40), lookahead=900)
+    scheduler.advance_workflows_forward(dbsession)
+    dbsession.refresh(workflow_instance)
+    assert workflow_instance.status == 'queued'
+
+    now = datetime(2017, 6, 3, 5, 50)
+    scheduler = Scheduler(taskflow, now_override=now, lookahead=900)
+    scheduler.advance_workflows_forward(dbsession)
+    dbsession.refresh(workflow_instance)
+    assert workflow_instance.status == 'running'
+    assert workflow_instance.started_at == run_at
+
+    ## the first tasks are queued, due at the workflow instance's run_at
+    task_instances = dbsession.query(TaskInstance).all()
+    assert len(task_instances) == 2
+    for instance in task_instances:
+        assert instance.run_at == run_at
+        assert instance.eligible_at == run_at
+
+    assert taskflow.pull(dbsession, 'test', now=now) == []
+    assert taskflow.get_next_eligible_at(dbsession, now=now) == run_at
+    assert len(taskflow.pull(dbsession, 'test', max_tasks=2, now=run_at)) == 2
+
+def test_backfill_workflow(dbsession, workflows):
+    taskflow = Taskflow()
+    taskflow.add_workflows(workflows)
+
+    scheduler = Scheduler(taskflow, now_override=datetime(2017, 6, 10))
+    queued = scheduler.backfill(dbsession, workflows[0], datetime(2017, 6, 1), datetime(2017, 6, 5, 12), priority='low')
+    assert queued == 5
+
+    workflow_instances = dbsession.query(WorkflowInstance).order_by(WorkflowInstance.run_at).all()
+    assert [workflow_instance.run_at for workflow_instance in workflow_instances] == \
+        [datetime(2017, 6, day, 6) for day in range(1, 6)]
+    for workflow_instance in workflow_instances:
+        assert workflow_instance.status == 'queued'
+        assert workflow_instance.scheduled == True
+        assert workflow_instance.priority == 'low'
+
+    ## runs that are already queued are skipped
+    assert scheduler.backfill(dbsession, workflows[0], datetime(2017, 6, 1), datetime(2017, 6, 6, 12)) == 1
+
+    ## the workflow's concurrency of 1 caps how many run at once
+    scheduler.advance_workflows_forward(dbsession)
+    running = dbsession.query(WorkflowInstance).filter(WorkflowInstance.status == 'running').all()
+    assert len(running) == 1
+    assert running[0].run_at == datetime(2017, 6, 1, 6)
@@ -1,12 +1,16 @@
 from datetime import datetime
 from functools import reduce
+import json
+import time
 import uuid
 
 import pytest
 import boto3
 
 from taskflow import Scheduler, Pusher, Taskflow, Task, TaskInstance
-from taskflow.push_workers.aws_batch import AWSBatchPushWorker
+from taskflow.push_workers.aws_batch import AWSBatchPushWorker, SQSJobEventSource
+from taskflow.push_workers.base import PushWorker, RateLimiter, FakeStateEventSource
+from taskflow.monitoring.base import Monitor, MonitorDestination
 from shared_fixtures import *
 
 get_logging()
@@ -15,13 +19,25 @@ class MockAWSBatch(object):
     def __init__(self, jobs, status):
         self.jobs = jobs
         self.status = status
-
-    def describe_jobs(self, *args, **kwargs):
-        jobs_with_status = self.jobs.copy()
+        self.started_at = None
+        self.terminated = []
+        self.terminate_error = None
+
+    def describe_jobs(self, jobs=None):
+        if len(jobs) > 100:
+            raise Exception('describe_jobs accepts up to 100 jobs')
+        jobs_with_status = [job for job in self.jobs if job['jobId'] in jobs]
         for job in jobs_with_status:
             job['status'] = self.status
+            if self.status in ['STARTING', 'RUNNING'] and self.started_at != None:
+                job['startedAt'] = int((self.started_at - datetime(1970, 1, 1)).total_seconds() * 1000)
         return {'jobs': jobs_with_status}
 
+    def terminate_job(self, jobId=None, reason=None):
+        if self.terminate_error != None:
+            raise self.terminate_error
+        self.terminated.append(jobId)
+
     def remove_job(self, job_id): ## only added for testing
         for job in self.jobs:
             if job['jobId'] == job_id:
@@ -146,7 +162,8 @@ def test_fail_retry(dbsession, monkeypatch):
     assert pushed_task_instance.ended_at == None
 
     mock_aws_batch.remove_job(pushed_task_instance.push_state['jobId'])
-    pusher.now_override = datetime(2017, 6, 4, 6, 5)
+    ## not eligible for retry until the retry_delay has passed, at 6:05
+    pusher.now_override = datetime(2017, 6, 4, 6, 4)
 
     mock_aws_batch.status = 'FAILED'
     pusher.run(dbsession)
@@ -161,6 +178,352 @@ def test_fail_retry(dbsession, monkeypatch):
     assert pushed_task_instance.status == 'failed'
     assert pushed_task_instance.ended_at == datetime(2017, 6, 4, 6, 10)
 
+def test_push_concurrent(dbsession, monkeypatch):
+    mock_aws_batch = MockAWSBatch([], 'SUBMITTED')
+    monkeypatch.setattr(boto3, 'client', mockbatch(mock_aws_batch))
+
+    task1 = Task(name='task1', active=True, push_destination='aws_batch', concurrency=None)
+    dbsession.add(task1)
+    taskflow = Taskflow()
+    taskflow.add_task(task1)
+    push_worker = AWSBatchPushWorker(taskflow, api_threads=4, submit_rate=1000)
+    taskflow.add_push_worker(push_worker)
+    taskflow.sync_db(dbsession)
+
+    for i in range(25):
+        dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6), unique=str(i)))
+    dbsession.commit()
+
+    ## drained in batches of 10
+    pusher = Pusher(taskflow, now_override=datetime(2017, 6, 4, 6), max_tasks=10)
+    pusher.run(dbsession)
+
+    assert len(mock_aws_batch.jobs) == 25
+    task_instances = dbsession.query(TaskInstance).all()
+    assert len(task_instances) == 25
+    job_ids = set()
+    for task_instance in task_instances:
+        assert task_instance.status == 'pushed'
+        assert task_instance.push_state['jobName'] == 'task1__{}'.format(task_instance.id)
+        job_ids.add(task_instance.push_state['jobId'])
+    assert len(job_ids) == 25
+
+    ## closing the pusher shuts down the API pool
+    pusher.close()
+    with pytest.raises(RuntimeError):
+        push_worker.api_pool.submit(lambda: None)
+
+def test_sync_states(dbsession, monkeypatch):
+    mock_aws_batch = MockAWSBatch([], 'SUBMITTED')
+    monkeypatch.setattr(boto3, 'client', mockbatch(mock_aws_batch))
+
+    task1 = Task(name='task1', active=True, push_destination='aws_batch', concurrency=None, timeout=3600)
+    dbsession.add(task1)
+    taskflow = Taskflow()
+    taskflow.add_task(task1)
+    taskflow.add_push_worker(AWSBatchPushWorker(taskflow, submit_rate=1000))
+    taskflow.sync_db(dbsession)
+
+    for i in range(150):
+        dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6), unique=str(i)))
+    dbsession.commit()
+
+    ## more jobs than a describe_jobs call accepts, over multiple pages
+    pusher = Pusher(taskflow, now_override=datetime(2017, 6, 4, 6), max_tasks=150, sync_page_size=120)
+    pusher.run(dbsession)
+    assert dbsession.query(TaskInstance).filter(TaskInstance.status == 'pushed').count() == 150
+
+    ## waiting for capacity past the task's timeout, without a queue_timeout
+    mock_aws_batch.status = 'RUNNABLE'
+    pusher.now_override = datetime(2017, 6, 4, 7, 30)
+    pusher.run(dbsession)
+    assert len(mock_aws_batch.terminated) == 0
+    assert dbsession.query(TaskInstance).filter(TaskInstance.status == 'pushed').count() == 150
+
+    mock_aws_batch.status = 'RUNNING'
+    mock_aws_batch.started_at = datetime(2017, 6, 4, 7, 30)
+    pusher.run(dbsession)
+    assert dbsession.query(TaskInstance).filter(TaskInstance.status == 'running').count() == 150
+
+    ## jobs missing from AWS Batch fail
+    task_instances = dbsession.query(TaskInstance).order_by(TaskInstance.id).all()
+    missing_task_instance = task_instances[0]
+    mock_aws_batch.remove_job(missing_task_instance.push_state['jobId'])
+    pusher.run(dbsession)
+    dbsession.refresh(missing_task_instance)
+    assert missing_task_instance.status == 'failed'
+    assert missing_task_instance.push_state['missing'] == True
+
+    ## running past the timeout, a failed terminate_job is retried on the next sync
+    pusher.now_override = datetime(2017, 6, 4, 8, 30)
+    mock_aws_batch.terminate_error = Exception('Throttled')
+    pusher.run(dbsession)
+    assert dbsession.query(TaskInstance).filter(TaskInstance.status == 'running').count() == 149
+
+    mock_aws_batch.terminate_error = None
+    pusher.run(dbsession)
+    assert len(mock_aws_batch.terminated) == 149
+    assert dbsession.query(TaskInstance).filter(TaskInstance.status == 'failed').count() == 150
+
+def test_sync_states_queue_timeout(dbsession, monkeypatch):
+    mock_aws_batch = MockAWSBatch([], 'SUBMITTED')
+    monkeypatch.setattr(boto3, 'client', mockbatch(mock_aws_batch))
+
+    task1 = Task(name='task1', active=True, push_destination='aws_batch', timeout=300)
+    dbsession.add(task1)
+    taskflow = Taskflow()
+    taskflow.add_task(task1)
+    taskflow.add_push_worker(AWSBatchPushWorker(taskflow, queue_timeout=3600))
+    taskflow.sync_db(dbsession)
+
+    dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6)))
+    dbsession.commit()
+
+    pusher = Pusher(taskflow, now_override=datetime(2017, 6, 4, 6))
+    pusher.run(dbsession)
+
+    ## waiting past the task's timeout, within the queue_timeout
+    mock_aws_batch.status = 'RUNNABLE'
+    pusher.now_override = datetime(2017, 6, 4, 6, 30)
+    pusher.run(dbsession)
+    task_instance = dbsession.query(TaskInstance).one()
+    assert task_instance.status == 'pushed'
+
+    pusher.now_override = datetime(2017, 6, 4, 7)
+    pusher.run(dbsession)
+    dbsession.refresh(task_instance)
+    assert task_instance.status == 'failed'
+    assert len(mock_aws_batch.terminated) == 1
+
+def test_scheduler_skips_push_timeouts(dbsession, monkeypatch):
+    mock_aws_batch = MockAWSBatch([], 'SUBMITTED')
+    monkeypatch.setattr(boto3, 'client', mockbatch(mock_aws_batch))
+
+    task1 = Task(name='task1', active=True, push_destination='aws_batch', timeout=300)
+    dbsession.add(task1)
+    taskflow = Taskflow()
+    taskflow.add_task(task1)
+    taskflow.add_push_worker(AWSBatchPushWorker(taskflow))
+    taskflow.sync_db(dbsession)
+
+    dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6)))
+    dbsession.commit()
+
+    pusher = Pusher(taskflow, now_override=datetime(2017, 6, 4, 6))
+    pusher.run(dbsession)
+
+    ## started after waiting in the job queue, past the task's timeout counted from the pull
+    mock_aws_batch.status = 'RUNNING'
+    mock_aws_batch.started_at = datetime(2017, 6, 4, 6, 30)
+    pusher.now_override = datetime(2017, 6, 4, 6, 31)
+    pusher.run(dbsession)
+
+    scheduler = Scheduler(taskflow, now_override=datetime(2017, 6, 4, 6, 31))
+    scheduler.fail_timedout_task_instances(dbsession)
+    dbsession.commit()
+
+    task_instance = dbsession.query(TaskInstance).one()
+    assert task_instance.status == 'running'
+
+    mock_aws_batch.status = 'SUCCEEDED'
+    pusher.now_override = datetime(2017, 6, 4, 6, 33)
+    pusher.run(dbsession)
+    dbsession.refresh(task_instance)
+    assert task_instance.status == 'success'
+    assert len(mock_aws_batch.terminated) == 0
+
+def test_sync_states_success(dbsession, monkeypatch):
+    mock_aws_batch = MockAWSBatch([], 'SUBMITTED')
+    monkeypatch.setattr(boto3, 'client', mockbatch(mock_aws_batch))
+
+    task1 = Task(name='task1', active=True, push_destination='aws_batch')
+    dbsession.add(task1)
+    taskflow = Taskflow()
+    taskflow.add_task(task1)
+    taskflow.add_push_worker(AWSBatchPushWorker(taskflow))
+    taskflow.sync_db(dbsession)
+
+    dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6)))
+    dbsession.commit()
+
+    pusher = Pusher(taskflow, now_override=datetime(2017, 6, 4, 6))
+    pusher.run(dbsession)
+
+    mock_aws_batch.status = 'SUCCEEDED'
+    pusher.now_override = datetime(2017, 6, 4, 6, 2)
+    pusher.run(dbsession)
+
+    task_instance = dbsession.query(TaskInstance).one()
+    assert task_instance.status == 'success'
+    assert task_instance.ended_at == datetime(2017, 6, 4, 6, 2)
+    assert task_instance.push_state['status'] == 'SUCCEEDED'
+
+def test_rate_limiter():
+    limiter = RateLimiter(20, burst=2)
+
+    started = time.monotonic()
+    limiter.acquire()
+    limiter.acquire()
+    assert time.monotonic() - started < 0.05
+
+    ## the burst is spent, the next calls wait for tokens
+    limiter.acquire()
+    limiter.acquire()
+    assert time.monotonic() - started >= 0.09
+
+class RecordingPushWorker(PushWorker):
+    def __init__(self, taskflow, push_type):
+        self.push_type = push_type
+        self.pushed = []
+        super(RecordingPushWorker, self).__init__(taskflow)
+
+    def push_task_instances(self, session, dry_run, task_instances):
+        self.pushed.append([task_instance.task_name for task_instance in task_instances])
+        for task_instance in task_instances:
+            task_instance.status = 'pushed'
+        session.commit()
+
+class RecordingMonitor(MonitorDestination):
+    def __init__(self):
+        self.batches = []
+
+    def push_batch(self, session, push_destination, action, size):
+        self.batches.append((push_destination, action, size))
+
+def test_push_batch_per_destination(dbsession):
+    task1 = Task(name='task1', active=True, push_destination='destination_a', concurrency=None)
+    task2 = Task(name='task2', active=True, push_destination='destination_b', concurrency=None)
+    dbsession.add(task1)
+    dbsession.add(task2)
+    monitor = RecordingMonitor()
+    taskflow = Taskflow(monitoring=Monitor(destinations=[monitor]))
+    taskflow.add_tasks([task1, task2])
+    destination_a = RecordingPushWorker(taskflow, 'destination_a')
+    destination_b = RecordingPushWorker(taskflow, 'destination_b')
+    taskflow.add_push_worker(destination_a)
+    taskflow.add_push_worker(destination_b)
+    taskflow.sync_db(dbsession)
+
+    ## interleaved destinations
+    for i in range(3):
+        dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6), unique=str(i)))
+        dbsession.add(task2.get_new_instance(run_at=datetime(2017, 6, 4, 6), unique=str(i)))
+    dbsession.commit()
+
+    pusher = Pusher(taskflow, now_override=datetime(2017, 6, 4, 6))
+    pusher.push_queued_task_instances(dbsession)
+
+    assert destination_a.pushed == [['task1', 'task1', 'task1']]
+    assert destination_b.pushed == [['task2', 'task2', 'task2']]
+    assert sorted(monitor.batches) == [('destination_a', 'push', 3), ('destination_b', 'push', 3)]
+    assert pusher.push_destinations == {'task1': 'destination_a', 'task2': 'destination_b'}
+
+def test_state_events(dbsession, monkeypatch):
+    mock_aws_batch = MockAWSBatch([], 'SUBMITTED')
+    monkeypatch.setattr(boto3, 'client', mockbatch(mock_aws_batch))
+
+    task1 = Task(name='task1', active=True, push_destination='aws_batch')
+    dbsession.add(task1)
+    event_source = FakeStateEventSource()
+    taskflow = Taskflow()
+    taskflow.add_task(task1)
+    taskflow.add_push_worker(AWSBatchPushWorker(taskflow, event_source=event_source))
+    taskflow.sync_db(dbsession)
+
+    dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6)))
+    dbsession.commit()
+
+    pusher = Pusher(taskflow, now_override=datetime(2017, 6, 4, 6), reconcile_interval=3600)
+    pusher.run(dbsession)
+
+    task_instance = dbsession.query(TaskInstance).one()
+    assert task_instance.status == 'pushed'
+    job_id = task_instance.push_state['jobId']
+    job_name = task_instance.push_state['jobName']
+
+    ## polling would still see SUBMITTED, the events are applied before the next reconciliation
+    event_source.put({'jobId': job_id, 'jobName': job_name, 'status': 'RUNNING'})
+    event_source.put({'jobId': 'other', 'jobName': 'not_taskflow', 'status': 'RUNNING'})
+    event_source.put(None)
+    pusher.now_override = datetime(2017, 6, 4, 6, 1)
+    pusher.run(dbsession)
+    dbsession.refresh(task_instance)
+    assert task_instance.status == 'running'
+    assert event_source.acked == [0, 1, 2]
+
+    ## a stale event received after the job started
+    event_source.put({'jobId': job_id, 'jobName': job_name, 'status': 'RUNNABLE'})
+    pusher.run(dbsession)
+    dbsession.refresh(task_instance)
+    assert task_instance.status == 'running'
+    assert task_instance.push_state['status'] == 'RUNNING'
+
+    ## out of order events, the job only moves forward
+    event_source.put({'jobId': job_id, 'jobName': job_name, 'status': 'SUCCEEDED'})
+    event_source.put({'jobId': job_id, 'jobName': job_name, 'status': 'RUNNING'})
+    pusher.now_override = datetime(2017, 6, 4, 6, 2)
+    pusher.run(dbsession)
+    dbsession.refresh(task_instance)
+    assert task_instance.status == 'success'
+    assert task_instance.ended_at == datetime(2017, 6, 4, 6, 2)
+    assert task_instance.push_state['status'] == 'SUCCEEDED'
+    assert len(event_source.acked) == 6
+
+class MockSQS(object):
+    def __init__(self, messages):
+        self.messages = messages
+        self.deleted = []
+
+    def receive_message(self, QueueUrl=None, MaxNumberOfMessages=None, WaitTimeSeconds=None):
+        messages = self.messages[:MaxNumberOfMessages]
+        self.messages = self.messages[MaxNumberOfMessages:]
+        if len(messages) == 0:
+            return {}
+        return {'Messages': messages}
+
+    def delete_message_batch(self, QueueUrl=None, Entries=None):
+        if len(Entries) > 10:
+            raise Exception('delete_message_batch accepts up to 10 messages')
+        self.deleted.append([entry['ReceiptHandle'] for entry in Entries])
+
+def test_sqs_job_event_source(monkeypatch):
+    messages = []
+    for i in range(12):
+        messages.append({
+            'MessageId': str(i),
+            'ReceiptHandle': 'receipt{}'.format(i),
+            'Body': json.dumps({
+                'source': 'aws.batch',
+                'detail-type': 'Batch Job State Change',
+                'detail': {'jobId': 'job{}'.format(i), 'jobName': 'task1__{}'.format(i), 'status': 'RUNNING'}
+            })
+        })
+    messages.append({'MessageId': '12', 'ReceiptHandle': 'receipt12', 'Body': 'not json'})
+    messages.append({'MessageId': '13', 'ReceiptHandle': 'receipt13',
+                     'Body': json.dumps({'source': 'aws.ec2', 'detail-type': 'EC2 Instance State-change Notification'})})
+    mock_sqs = MockSQS(messages)
+    monkeypatch.setattr(boto3, 'client', lambda aws_resource: mock_sqs)
+
+    event_source = SQSJobEventSource('https://sqs.us-east-1.amazonaws.com/123/batch-events')
+
+    events = event_source.receive()
+    assert len(events) == 10
+    assert events[0] == ({'jobId': 'job0', 'jobName': 'task1__0', 'status': 'RUNNING'}, 'receipt0')
+
+    ## messages that are not Batch job state changes are received without an event, to be acked
+    events += event_source.receive()
+    assert [job for job, receipt in events[10:]] == [
+        {'jobId': 'job10', 'jobName': 'task1__10', 'status': 'RUNNING'},
+        {'jobId': 'job11', 'jobName': 'task1__11', 'status': 'RUNNING'},
+        None,
+        None]
+    assert event_source.receive() == []
+
+    event_source.ack([receipt for job, receipt in events])
+    assert mock_sqs.deleted == [
+        ['receipt{}'.format(i) for i in range(10)],
+        ['receipt{}'.format(i) for i in range(10, 14)]]
+
 ## TODO: test task and task_instance job_queue param
 
 ## TODO: test task and task_instance job_definition param
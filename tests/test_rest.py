@@ -3,6 +3,8 @@ import pytest
 from shared_fixtures import *
 from restful_ben.test_utils import json_call, login as orig_login, dict_contains, iso_regex
 
+from taskflow.rest.resources import DefinitionCache
+
 def login(*args, **kwargs):
     kwargs['path'] = '/v1/session'
     return orig_login(*args, **kwargs)
@@ -124,6 +126,39 @@ def test_list_tasks(app):
         'default_priority': 'normal'
     })
 
+def test_update_workflow(app, dbsession):
+    test_client = app.test_client()
+    csrf_token = login(test_client)
+
+    response = json_call(test_client.put, '/v1/workflows/workflow1', {'active': False}, headers={'X-CSRF': csrf_token})
+    assert response.status_code == 200
+    assert response.json['active'] == False
+
+    ## the PUT invalidates the cached flags
+    response = json_call(test_client.get, '/v1/workflows/workflow1')
+    assert response.json['active'] == False
+    assert dbsession.query(Workflow).get('workflow1').active == False
+
+def test_definition_cache(dbsession):
+    workflow = Workflow(name='cached_workflow', active=True)
+    taskflow = Taskflow()
+    taskflow.add_workflow(workflow)
+    taskflow.sync_db(dbsession)
+
+    cache = DefinitionCache(taskflow, ttl=3600)
+    cache.refresh(dbsession)
+
+    dbsession.execute("UPDATE workflows SET active = false WHERE name = 'cached_workflow'")
+    dbsession.commit()
+
+    ## served from the cache within the ttl
+    cache.refresh(dbsession)
+    assert workflow.active == True
+
+    cache.invalidate()
+    cache.refresh(dbsession)
+    assert workflow.active == False
+
 def test_create_workflow_instance(app, instances):
     test_client = app.test_client()
     csrf_token = login(test_client)
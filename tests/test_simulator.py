@@ -0,0 +1,66 @@
+from datetime import datetime
+
+import pytest
+
+from taskflow import Taskflow, Task, Workflow
+from taskflow.core.simulator import Simulator, constant, uniform, percentile
+
+@pytest.fixture
+def taskflow():
+    workflow = Workflow(name='hourly_workflow', active=True, schedule='0 * * * *')
+    task_a = Task(workflow=workflow, name='task_a', active=True)
+    task_b = Task(workflow=workflow, name='task_b', active=True)
+    task_c = Task(workflow=workflow, name='task_c', active=True)
+    task_c.depends_on(task_a)
+    task_c.depends_on(task_b)
+
+    taskflow = Taskflow()
+    taskflow.add_workflow(workflow)
+    return taskflow
+
+def test_percentile():
+    assert percentile([], 50) == None
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile([1, 2, 3, 4], 100) == 4
+    assert percentile([1, 2, 3, 4], 0) == 1
+
+def test_simulate_one_worker(taskflow):
+    simulator = Simulator(taskflow, workers=1, default_duration=constant(600))
+    report = simulator.run(datetime(2017, 6, 3), datetime(2017, 6, 3, 3, 59))
+
+    assert report.workflow_runs == 3
+    assert report.task_runs == 9
+    ## task_b waits on task_a for the only worker
+    assert report.start_latency[50] == 0
+    assert report.start_latency[100] == 600
+    assert report.peak_queue_depth == 2
+    assert report.peak_running == 1
+    assert report.queue_depth[0] == (datetime(2017, 6, 3, 1), 1)
+    ## 9 runs of 10 minutes, from midnight until the last run ends at 3:30
+    assert report.utilization == pytest.approx(5400.0 / 12600.0)
+
+def test_simulate_workers(taskflow):
+    simulator = Simulator(taskflow, workers=2, default_duration=constant(600))
+    report = simulator.run(datetime(2017, 6, 3), datetime(2017, 6, 3, 3, 59))
+
+    assert report.task_runs == 9
+    assert report.start_latency[100] == 0
+    assert report.peak_running == 2
+
+def test_simulate_task_concurrency():
+    task = Task(name='frequent_task', active=True, schedule='*/10 * * * *', concurrency=1)
+    other_task = Task(name='other_task', active=True, schedule='*/10 * * * *')
+    taskflow = Taskflow()
+    taskflow.add_tasks([task, other_task])
+
+    simulator = Simulator(taskflow,
+                          workers=4,
+                          durations={'frequent_task': uniform(60, 120)},
+                          default_duration=constant(30),
+                          seed=1)
+    report = simulator.run(datetime(2017, 6, 3), datetime(2017, 6, 10))
+
+    ## one week of runs every 10 minutes, from 00:10 on the first day
+    assert report.task_runs == 2 * (7 * 24 * 6)
+    assert report.peak_running == 2
+    assert report.start_latency[100] == 0
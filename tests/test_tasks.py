@@ -1,9 +1,16 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import os
+import signal
+import threading
+import time
 
 import pytest
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
 
-from taskflow import Scheduler, Taskflow, Task, TaskInstance
+from taskflow import Scheduler, Taskflow, Task, TaskInstance, Worker
+from taskflow.core.worker import TaskInstanceListener, WorkerPool, PreforkWorkerPool
+from taskflow.tasks.bash_task import BashTask
 from shared_fixtures import *
 
 get_logging()
@@ -380,3 +387,381 @@ def test_task_retry_fail(dbsession, engine):
 
     assert pulled_task_instance.status == 'failed'
     assert pulled_task_instance.ended_at == datetime(2017, 6, 4, 6, 5, 20)
+
+def test_task_eligible_at(dbsession, engine):
+    task1 = Task(name='task1', active=True, retries=1, timeout=600, retry_delay=120)
+    dbsession.add(task1)
+    taskflow = Taskflow()
+    taskflow.add_task(task1)
+
+    task_instance = task1.get_new_instance(run_at=datetime(2017, 6, 4, 6), priority='high')
+    dbsession.add(task_instance)
+    dbsession.commit()
+
+    assert task_instance.priority_rank == 2
+    assert task_instance.eligible_at == datetime(2017, 6, 4, 6)
+
+    dbsession.expunge_all()
+
+    pulled_task_instance = taskflow.pull(dbsession, 'test', now=datetime(2017, 6, 4, 6, 0, 12))[0]
+    assert pulled_task_instance.eligible_at == datetime(2017, 6, 4, 6, 10, 12)
+
+    pulled_task_instance.fail(dbsession, taskflow, now=datetime(2017, 6, 4, 6, 0, 15))
+    dbsession.refresh(pulled_task_instance)
+    assert pulled_task_instance.status == 'retry'
+    assert pulled_task_instance.eligible_at == datetime(2017, 6, 4, 6, 2, 15)
+
+    dbsession.expunge_all()
+
+    pulled_task_instance = taskflow.pull(dbsession, 'test', now=datetime(2017, 6, 4, 6, 2, 15))[0]
+    pulled_task_instance.succeed(dbsession, taskflow, now=datetime(2017, 6, 4, 6, 2, 20))
+    dbsession.refresh(pulled_task_instance)
+    assert pulled_task_instance.status == 'success'
+    assert pulled_task_instance.eligible_at == None
+
+def test_next_eligible_at_attempts(dbsession, engine):
+    task1 = Task(name='task1', active=True, retries=0, timeout=600)
+    dbsession.add(task1)
+    taskflow = Taskflow()
+    taskflow.add_task(task1)
+
+    dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6, 5)))
+    dbsession.commit()
+    assert taskflow.get_next_eligible_at(dbsession, now=datetime(2017, 6, 4, 6)) == datetime(2017, 6, 4, 6, 5)
+
+    pulled_task_instance = taskflow.pull(dbsession, 'test', now=datetime(2017, 6, 4, 6, 5))[0]
+    assert pulled_task_instance.eligible_at == datetime(2017, 6, 4, 6, 15)
+    dbsession.commit()
+
+    ## its only attempt is running, it can not be pulled again once it times out
+    assert taskflow.get_next_eligible_at(dbsession, now=datetime(2017, 6, 4, 6, 6)) == None
+
+def test_queue_notifies_listener(dbsession, engine):
+    task1 = Task(name='task1', active=True)
+    task2 = Task(name='task2', active=True)
+    dbsession.add(task1)
+    dbsession.add(task2)
+    dbsession.commit()
+
+    listener = TaskInstanceListener(engine, task_names=['task1'])
+    listener.connect()
+
+    ## filtered out by task_names
+    dbsession.add(task2.get_new_instance(run_at=datetime(2017, 6, 4, 6)))
+    dbsession.commit()
+    assert listener.wait(0.5) == False
+
+    dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6)))
+    dbsession.commit()
+    assert listener.wait(5) == True
+
+    listener.close()
+
+class SleepTask(Task):
+    def execute(self, task_instance):
+        time.sleep(0.5)
+
+def test_worker_pool(dbsession, engine):
+    task1 = SleepTask(name='task1', active=True)
+    dbsession.add(task1)
+    taskflow = Taskflow()
+    taskflow.add_task(task1)
+
+    for i in range(4):
+        dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6), unique=str(i)))
+    dbsession.commit()
+
+    pool = WorkerPool(Worker(taskflow), sessionmaker(bind=engine), 4)
+    assert pool.free_slots() == 4
+
+    task_instances = taskflow.pull(dbsession, 'test', max_tasks=pool.free_slots(), now=datetime(2017, 6, 4, 6, 0, 12))
+    assert len(task_instances) == 4
+    task_instance_ids = [task_instance.id for task_instance in task_instances]
+    dbsession.commit()
+
+    start = time.time()
+    for task_instance_id in task_instance_ids:
+        pool.submit(task_instance_id)
+    assert pool.free_slots() == 0
+    pool.shutdown()
+    assert time.time() - start < 2
+
+    dbsession.expire_all()
+    for task_instance in dbsession.query(TaskInstance).all():
+        assert task_instance.status == 'success'
+
+def test_kill_concurrent_bash_tasks():
+    task = BashTask(name='bash_task', active=True, params={'command': 'sleep 30'})
+    taskflow = Taskflow()
+    taskflow.add_task(task)
+    worker = Worker(taskflow)
+
+    failed = []
+    def execute(task_instance):
+        try:
+            task.execute(task_instance)
+        except Exception:
+            failed.append(task_instance.id)
+
+    threads = []
+    for task_instance_id in [1, 2]:
+        task_instance = TaskInstance(id=task_instance_id, task_name='bash_task', params={})
+        worker.running_tasks[task_instance_id] = task
+        thread = threading.Thread(target=execute, args=(task_instance,))
+        thread.start()
+        threads.append(thread)
+
+    start = time.time()
+    while len(task.processes) < 2 and time.time() - start < 5:
+        time.sleep(0.05)
+    processes = list(task.processes.values())
+    assert len(processes) == 2
+
+    with pytest.raises(SystemExit):
+        worker.on_kill(None, None)
+
+    for thread in threads:
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+    ## both bash processes were terminated, not only the last one started
+    for sp in processes:
+        assert sp.returncode == -15
+    assert sorted(failed) == [1, 2]
+    assert task.processes == {}
+
+def test_prefork_worker_pool(dbsession, engine):
+    task1 = SleepTask(name='task1', active=True)
+    dbsession.add(task1)
+    taskflow = Taskflow()
+    taskflow.add_task(task1)
+
+    for i in range(4):
+        dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6), unique=str(i)))
+    dbsession.commit()
+
+    pool = PreforkWorkerPool(taskflow, engine, 2, max_tasks_per_child=1)
+    assert pool.free_slots() == 2
+
+    for n in range(2):
+        task_instances = taskflow.pull(dbsession, 'test', max_tasks=pool.free_slots(), now=datetime(2017, 6, 4, 6, 0, 12))
+        assert len(task_instances) == 2
+        task_instance_ids = [task_instance.id for task_instance in task_instances]
+        dbsession.commit()
+
+        for task_instance_id in task_instance_ids:
+            pool.submit(task_instance_id)
+        assert pool.free_slots() == 0
+
+        while pool.free_slots() < 2:
+            pool.wait(timeout=5)
+
+    ## every child was recycled after its task
+    assert len(pool.children) == 2
+    pool.shutdown()
+
+    dbsession.expire_all()
+    for task_instance in dbsession.query(TaskInstance).all():
+        assert task_instance.status == 'success'
+
+def test_prefork_worker_pool_child_exits(dbsession, engine):
+    task1 = SleepTask(name='task1', active=True)
+    dbsession.add(task1)
+    taskflow = Taskflow()
+    taskflow.add_task(task1)
+
+    dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6)))
+    dbsession.commit()
+
+    pool = PreforkWorkerPool(taskflow, engine, 1)
+    task_instance = taskflow.pull(dbsession, 'test', max_tasks=1, now=datetime(2017, 6, 4, 6, 0, 12))[0]
+    dbsession.commit()
+
+    pool.submit(task_instance.id)
+    assert pool.free_slots() == 0
+    [pid] = pool.children.keys()
+
+    ## the child dies before reporting its task instance, its slot is reclaimed
+    os.kill(pid, signal.SIGKILL)
+    pool.wait(timeout=5)
+    assert pool.free_slots() == 1
+    assert len(pool.children) == 1
+    assert pid not in pool.children
+    pool.shutdown()
+
+def test_prefork_worker_pool_recycling(dbsession, engine):
+    task1 = SleepTask(name='task1', active=True, concurrency=None)
+    dbsession.add(task1)
+    taskflow = Taskflow()
+    taskflow.add_task(task1)
+
+    for i in range(3):
+        dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6), unique=str(i)))
+    dbsession.commit()
+
+    pool = PreforkWorkerPool(taskflow, engine, 1, max_tasks_per_child=1)
+    task_instances = taskflow.pull(dbsession, 'test', max_tasks=3, now=datetime(2017, 6, 4, 6, 0, 12))
+    task_instance_ids = [task_instance.id for task_instance in task_instances]
+    dbsession.commit()
+
+    ## each task instance goes to a new child, never to the one exiting after its task
+    for task_instance_id in task_instance_ids[:2]:
+        pool.wait(timeout=5)
+        assert pool.free_slots() == 1
+        pool.submit(task_instance_id)
+
+    ## a child that dies before taking its task instance, the instance is submitted again
+    pool.wait(timeout=5)
+    [pid] = pool.children.keys()
+    os.kill(pid, signal.SIGKILL)
+    while pool.children[pid].is_alive():
+        time.sleep(0.05)
+    pool.submit(task_instance_ids[2])
+    assert pool.free_slots() == 0
+    assert pid not in pool.children
+
+    pool.wait(timeout=5)
+    pool.shutdown()
+
+    dbsession.expire_all()
+    for task_instance in dbsession.query(TaskInstance).all():
+        assert task_instance.status == 'success'
+
+def test_pull_task_concurrency(dbsession, engine):
+    task1 = Task(name='task1', active=True, concurrency=2)
+    task2 = Task(name='task2', active=True)
+    taskflow = Taskflow()
+    taskflow.add_tasks([task1, task2])
+    taskflow.sync_db(dbsession)
+
+    for i in range(3):
+        dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6), unique=str(i)))
+    dbsession.add(task2.get_new_instance(run_at=datetime(2017, 6, 4, 6, 0, 5)))
+    dbsession.commit()
+
+    now = datetime(2017, 6, 4, 6, 0, 12)
+
+    pulled_task_instances = taskflow.pull(dbsession, 'test', max_tasks=4, now=now)
+    dbsession.commit()
+    assert len(pulled_task_instances) == 3
+    assert len(list(filter(lambda ti: ti.task_name == 'task1', pulled_task_instances))) == 2
+
+    ## task1 and task2 are at their limits
+    assert taskflow.pull(dbsession, 'test', max_tasks=4, now=now) == []
+
+    pulled_task_instances[0].succeed(dbsession, taskflow, now=now)
+
+    pulled_task_instances = taskflow.pull(dbsession, 'test', max_tasks=4, now=now)
+    dbsession.commit()
+    assert len(pulled_task_instances) == 1
+    assert pulled_task_instances[0].task_name == 'task1'
+
+def test_pull_concurrent_sessions(dbsession, engine):
+    task1 = Task(name='task1', active=True)
+    task2 = Task(name='task2', active=True)
+    taskflow = Taskflow()
+    taskflow.add_tasks([task1, task2])
+    taskflow.sync_db(dbsession)
+
+    for i in range(2):
+        dbsession.add(task1.get_new_instance(run_at=datetime(2017, 6, 4, 6), unique=str(i)))
+    dbsession.add(task2.get_new_instance(run_at=datetime(2017, 6, 4, 6, 0, 5)))
+    dbsession.commit()
+
+    now = datetime(2017, 6, 4, 6, 0, 12)
+    other_session = sessionmaker(bind=engine)()
+
+    ## the first pull holds task1's slot until it commits, the second pull gets other work
+    pulled_task_instances = taskflow.pull(dbsession, 'worker1', max_tasks=1, now=now)
+    assert [ti.task_name for ti in pulled_task_instances] == ['task1']
+
+    other_pulled_task_instances = taskflow.pull(other_session, 'worker2', max_tasks=1, now=now)
+    assert [ti.task_name for ti in other_pulled_task_instances] == ['task2']
+
+    dbsession.commit()
+    other_session.commit()
+    other_session.close()
+
+def test_get_most_recent_instances(dbsession, tasks):
+    taskflow = Taskflow()
+    taskflow.add_tasks(tasks)
+
+    for day in [3, 4, 5]:
+        dbsession.add(tasks[1].get_new_instance(scheduled=True, run_at=datetime(2017, 6, day, 6), unique=str(day)))
+    dbsession.add(tasks[3].get_new_instance(scheduled=True, run_at=datetime(2017, 6, 4, 2)))
+    ## not scheduled, ignored
+    dbsession.add(tasks[3].get_new_instance(run_at=datetime(2017, 6, 6, 2)))
+    dbsession.commit()
+
+    scheduler = Scheduler(taskflow)
+    most_recent_instances = scheduler.get_most_recent_instances(dbsession, TaskInstance, ['task1', 'task2', 'task4'])
+
+    assert len(most_recent_instances) == 2
+    assert most_recent_instances['task2'].run_at == datetime(2017, 6, 5, 6)
+    assert most_recent_instances['task4'].run_at == datetime(2017, 6, 4, 2)
+
+def test_schedule_recurring_timer_heap(dbsession, tasks):
+    taskflow = Taskflow()
+    taskflow.add_tasks(tasks)
+    scheduler = Scheduler(taskflow, now_override=datetime(2017, 6, 3, 6), rebuild_interval=86400)
+    scheduler.run(dbsession)
+
+    ## both recurring tasks are parked until their queued run
+    assert sorted(scheduler.recurring_heaps[Task]) == [
+        (datetime(2017, 6, 4, 2), 'task4'),
+        (datetime(2017, 6, 4, 6), 'task2')
+    ]
+
+    scheduler.now_override = datetime(2017, 6, 3, 12)
+    assert scheduler.get_due_items(Task, [tasks[1], tasks[3]], scheduler.now()) == []
+
+    ## changing the definitions rebuilds the heap
+    tasks[3].schedule = '0 3 * * *'
+    due_items = scheduler.get_due_items(Task, [tasks[1], tasks[3]], scheduler.now())
+    assert set(item.name for item in due_items) == set(['task2', 'task4'])
+
+def test_insert_task_instances(dbsession, tasks):
+    taskflow = Taskflow()
+    taskflow.add_tasks(tasks)
+
+    run_at = datetime(2017, 6, 4, 6)
+    ids = taskflow.insert_task_instances(dbsession, [
+        tasks[0].get_new_instance(run_at=run_at, unique='a', priority='high'),
+        tasks[0].get_new_instance(run_at=run_at, unique='b'),
+        tasks[1].get_new_instance(run_at=run_at, unique='a')])
+    dbsession.commit()
+    assert len(ids) == 3
+
+    ## conflicts with active instances are skipped instead of raising
+    ids = taskflow.insert_task_instances(dbsession, [
+        tasks[0].get_new_instance(run_at=run_at, unique='a'),
+        tasks[2].get_new_instance(run_at=run_at, unique='a')])
+    dbsession.commit()
+    assert len(ids) == 1
+
+    task_instance = dbsession.query(TaskInstance).get(ids[0])
+    assert task_instance.task_name == 'task3'
+    assert task_instance.eligible_at == run_at
+    assert task_instance.priority_rank == 3
+
+    assert dbsession.query(TaskInstance).count() == 4
+    high = dbsession.query(TaskInstance).filter(TaskInstance.priority == 'high').one()
+    assert high.priority_rank == 2
+
+def test_schedule_jitter():
+    task1 = Task(name='task1', schedule='0 * * * *', jitter=900)
+    task2 = Task(name='task2', schedule='0 * * * *', jitter=900)
+    task3 = Task(name='task3', schedule='0 * * * *')
+
+    base_time = datetime(2017, 6, 3, 6, 30)
+    assert task3.next_run(base_time=base_time) == datetime(2017, 6, 3, 7)
+
+    offset = task1.get_jitter_offset()
+    assert offset.total_seconds() < 900
+    assert task1.get_jitter_offset() == offset
+    assert task1.get_jitter_offset() != task2.get_jitter_offset()
+
+    next_run = task1.next_run(base_time=base_time)
+    assert next_run == datetime(2017, 6, 3, 7) + offset
+    assert task1.next_run(base_time=next_run) == next_run + timedelta(hours=1)
+    assert task1.last_run(base_time=next_run + timedelta(minutes=1)) == next_run
+    assert task1.last_run(base_time=base_time) == datetime(2017, 6, 3, 6) + offset